@@ -1,22 +1,32 @@
-import random
+import bisect
+import time
 import argparse
-import codecs
+import functools
+import itertools
+import json
+import math
 import os
 import sys
+import tempfile
+import threading
+import zipfile
 from collections import defaultdict
 from pathlib import Path
 
 import numpy
-from torch.distributed.tensor import empty
+
+from process_pools import process_pool
 
 
 # Sequence - represents a sequence of hidden states and corresponding
 # output variables.
 
 class Sequence:
-    def __init__(self, stateseq, outputseq):
+    def __init__(self, stateseq, outputseq, logprob=None, loglikelihood=None):
         self.stateseq  = stateseq   # sequence of states
         self.outputseq = outputseq  # sequence of outputs
+        self.logprob = logprob              # log P(stateseq, outputseq), when decoded
+        self.loglikelihood = loglikelihood  # log P(outputseq), when decoded
     def __str__(self):
         return ' '.join(self.stateseq)+'\n'+' '.join(self.outputseq)+'\n'
     def __repr__(self):
@@ -24,55 +34,1084 @@ class Sequence:
     def __len__(self):
         return len(self.outputseq)
 
+# Profiler - opt-in timings of the phases of loading and decoding, e.g.
+#
+#     with Profiler() as profile:
+#         h.load("partofspeech")
+#         h.viterbi(tokens)
+#     print(profile.report())
+#     profile.save("viterbi.trace.json", "chrome")   # for chrome://tracing or Perfetto
+#
+# Only the process the profiler runs in is recorded, not --jobs workers.
+
+_profiler = None
+
+class Profiler:
+    def __init__(self):
+        self.events = []                  # (phase, start offset, seconds, thread, counters)
+        self.counters = defaultdict(int)  # totals counted outside any one phase, e.g. states_pruned
+        self._previous = None
+        self._origin = None
+    def start(self):
+        global _profiler
+        self._previous = _profiler
+        self._origin = time.perf_counter()
+        _profiler = self
+        return self
+    def stop(self):
+        global _profiler
+        _profiler = self._previous
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *exc):
+        self.stop()
+    def record(self, phase, start, seconds, counters):
+        self.events.append((phase, start - self._origin, seconds, threading.get_ident(), counters))
+    def count(self, name, n=1):
+        self.counters[name] += n
+    def summary(self):
+        """calls, total seconds and summed counters per phase, with tokens_per_s where
+        the phase decodes tokens. Nested phases (decode calls log_likelihood) count in both."""
+        phases = {}
+        for phase, _, seconds, _, counters in self.events:
+            totals = phases.setdefault(phase, {"calls": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+        for totals in phases.values():
+            if totals.get("tokens") and totals["seconds"] > 0:
+                totals["tokens_per_s"] = totals["tokens"] / totals["seconds"]
+        return phases
+    def report(self):
+        """the summary as a table, slowest phase first"""
+        lines = ["%-16s %7s %10s %12s  %s" % ("phase", "calls", "seconds", "tokens/s", "counters")]
+        for phase, totals in sorted(self.summary().items(), key=lambda item: -item[1]["seconds"]):
+            counters = " ".join("%s=%d" % (name, value) for name, value in totals.items()
+                                if name not in ("calls", "seconds", "tokens_per_s"))
+            lines.append("%-16s %7d %10.4f %12s  %s" % (phase, totals["calls"], totals["seconds"],
+                         "%.0f" % totals["tokens_per_s"] if "tokens_per_s" in totals else "-", counters))
+        if self.counters:
+            lines.append("counters: " + " ".join("%s=%d" % item for item in sorted(self.counters.items())))
+        return "\n".join(lines)
+    def save(self, path, format="json"):
+        """writes the summary and every event as JSON, or with format="chrome" in the
+        Trace Event format that chrome://tracing, Perfetto and speedscope open"""
+        if format == "chrome":
+            data = {"traceEvents": [{"name": phase, "ph": "X", "ts": offset * 1e6, "dur": seconds * 1e6,
+                                     "pid": os.getpid(), "tid": thread, "args": counters}
+                                    for phase, offset, seconds, thread, counters in self.events],
+                    "displayTimeUnit": "ms"}
+        else:
+            data = {"summary": self.summary(), "counters": dict(self.counters),
+                    "events": [{"phase": phase, "start": offset, "seconds": seconds, **counters}
+                               for phase, offset, seconds, _, counters in self.events]}
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+
+def _profiled(phase, counters=None):
+    """records each call of the method as phase while a Profiler is running, with
+    counters(self, args) added to the event. Costs one global lookup otherwise."""
+    def wrap(method):
+        @functools.wraps(method)
+        def profiled(self, *args, **kwargs):
+            if _profiler is None:
+                return method(self, *args, **kwargs)
+            profiler = _profiler
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            seconds = time.perf_counter() - start
+            profiler.record(phase, start, seconds, counters(self, args) if counters else {})
+            return result
+        return profiled
+    return wrap
+
+def _sequence_counters(hmm, args):
+    # The lattice is one cell per (token, state)
+    tokens = len(args[0]) if args else 0
+    states = len(hmm.states) if hmm.states is not None else len(hmm.transitions)
+    return {"tokens": tokens, "lattice_cells": tokens * states}
+
+def _dense_counters(hmm, args):
+    return {"zero_transitions": int(hmm.trans_probs.size - numpy.count_nonzero(hmm.trans_probs)),
+            "zero_emissions": int(hmm.emit_probs.size - numpy.count_nonzero(hmm.emit_probs))}
+
+def _sparse_counters(hmm, args):
+    n, v = len(hmm.states), len(hmm.symbol_index)
+    return {"zero_transitions": n * n - len(hmm.pred_states), "zero_emissions": v * n - len(hmm.emit_states)}
+
+# Compiled models are cached next to the .trans/.emit files as basename.npz
+CACHE_SUFFIX = ".npz"
+CACHE_VERSION = 2
+
 # HMM model
 class HMM:
-    def __init__(self, transitions={}, emissions={}):
+    def __init__(self, transitions={}, emissions={}, engine="dense", logspace=False, beam=None, beam_threshold=None, oov="zero", checkpoint=False):
         """creates a model from transition and emission probabilities
         e.g. {'happy': {'silent': '0.2', 'meow': '0.3', 'purr': '0.5'},
               'grumpy': {'silent': '0.5', 'meow': '0.4', 'purr': '0.1'},
               'hungry': {'silent': '0.2', 'meow': '0.6', 'purr': '0.2'}}"""
+        self._basename = None
         self.transitions = transitions
         self.emissions = emissions
+        # "dense" runs forward/viterbi over the compiled NumPy arrays,
+        # "sparse" over predecessor lists and a symbol -> emitting states index
+        # (always with log/normalized probabilities), and "dict" runs the
+        # original loops over the string dictionaries
+        self.engine = engine
+        # logspace runs the dense engine on log probabilities (viterbi) and
+        # per-step normalized probabilities (forward) so long sequences don't underflow
+        self.logspace = logspace
+        # beam keeps only the beam most probable states per column in viterbi, and
+        # beam_threshold only those within beam_threshold (in log probability) of the best;
+        # either makes viterbi approximate and log-space
+        if beam is not None and beam < 1:
+            raise ValueError("beam must keep at least 1 state, got %s" % beam)
+        if beam_threshold is not None and beam_threshold < 0:
+            raise ValueError("beam_threshold must be a non-negative log probability, got %s" % beam_threshold)
+        self.beam = beam
+        self.beam_threshold = beam_threshold
+        # How words missing from the .emit file are emitted: "zero" by no state (the
+        # original behaviour), "uniform" equally by every state, "suffix" like the rare
+        # known words that share their shape or longest suffix, see _unknown
+        self.oov = oov
+        # checkpoint runs viterbi in log space keeping only sqrt(T) columns of the lattice
+        # at a time, for sequences too long for all T backpointer columns to fit in memory
+        self.checkpoint = checkpoint
+        self._reset_compiled()
+
+    def _reset_compiled(self):
+        self.states = None
+        self.state_index = None
+        self.symbol_index = None
+        self.start_probs = None
+        # Nonzero entries as (from state, to state, prob) and (symbol, state, prob) triples,
+        # the dense and sparse engines each build their arrays from these when first used
+        self._trans_entries = None
+        self._emit_entries = None
+        self.trans_probs = None
+        self.emit_probs = None
+        self._emit_rows = None
+        self.pred_ptr = None
+        self.pred_states = None
+        self.pred_probs = None
+        self.emit_ptr = None
+        self.emit_states = None
+        self.emit_values = None
+        self._symbol_names = None
+        self._oov_classes = None
+        self._oov_cache = {}
+
+    @classmethod
+    def from_probabilities(cls, states, symbols, start_probs, trans_probs, emit_probs, **options):
+        """creates a model straight from arrays: start_probs (N,), trans_probs (N, N) with
+        P(state j | state i) at [i, j] and emit_probs (V, N) with P(symbol v | state j) at [v, j]"""
+        h = cls(**options)
+        trans_from, trans_to = numpy.nonzero(trans_probs)
+        emit_symbols, emit_states = numpy.nonzero(emit_probs)
+        h._set_arrays(list(states), {symbol: idx for idx, symbol in enumerate(symbols)}, numpy.asarray(start_probs, dtype=float),
+                      (trans_from, trans_to, trans_probs[trans_from, trans_to]),
+                      (emit_symbols, emit_states, emit_probs[emit_symbols, emit_states]))
+        h._transitions = None
+        h._emissions = None
+        h._ensure_compiled()
+        return h
+
+    # The dictionaries are only parsed from the text files when they're asked for,
+    # a model loaded from its compiled cache never needs them to decode. A trained
+    # model that has no files rebuilds them from its arrays instead.
+    @property
+    def transitions(self):
+        if self._transitions is None:
+            self._read_dicts()
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, transitions):
+        self._transitions = transitions
+        self._reset_compiled()
+
+    @property
+    def emissions(self):
+        if self._emissions is None:
+            self._read_dicts()
+        return self._emissions
+
+    @emissions.setter
+    def emissions(self, emissions):
+        self._emissions = emissions
+        self._reset_compiled()
 
     # Loading the contents of the basename to add to the proper attribute
-    def load(self, basename):
+    @_profiled("load")
+    def load(self, basename, cache=True):
+        """loads basename.trans and basename.emit. With cache set, the compiled
+        arrays are read from basename.npz when it is newer than both text files,
+        and written there after parsing them otherwise."""
         types = (".trans", ".emit")
+        # Validating that the paths exist
         for ftype in types :
-            tdict = defaultdict(dict)
-            path = Path(basename + ftype)
-            # Validating that the path exists
-            if not path.is_file() :
+            if not Path(basename + ftype).is_file() :
                 print("Please enter a valid basename for your .emit and .trans files")
                 sys.exit()
+        cache_path = Path(basename + CACHE_SUFFIX)
+        if cache and cache_path.is_file() :
+            source_mtime = max(Path(basename + ftype).stat().st_mtime for ftype in types)
+            if cache_path.stat().st_mtime >= source_mtime and self._load_compiled(cache_path) :
+                self._basename = basename
+                self._transitions = None
+                self._emissions = None
+                self._ensure_compiled()
+                return
+        self._read_text(basename)
+        self.compile()
+        if cache :
+            self.save_compiled(cache_path)
+        self._ensure_compiled()
+
+    def _read_dicts(self):
+        if self._basename is not None:
+            self._read_text(self._basename)
+            return
+        self._transitions = defaultdict(dict)
+        self._emissions = defaultdict(dict)
+        for line in self._entry_lines(".trans"):
+            state, next_state, prob = line.split(" ")
+            self._transitions[state][next_state] = prob
+        for line in self._entry_lines(".emit"):
+            state, symbol, prob = line.split(" ")
+            self._emissions[state][symbol] = prob
+
+    def _entry_lines(self, ftype):
+        # The lines of a .trans or .emit file for the compiled arrays, e.g. "happy purr 0.5"
+        if ftype == ".trans":
+            for state, prob in zip(self.states, self.start_probs):
+                if prob > 0:
+                    yield "# %s %r" % (state, float(prob))
+            entries = self._trans_entries
+            names = self.states
+        else:
+            entries = self._emit_entries
+            names = sorted(self.symbol_index, key=self.symbol_index.get)
+        if ftype == ".trans":
+            order = numpy.lexsort((entries[1], entries[0]))
+            for idx in order:
+                yield "%s %s %r" % (self.states[entries[0][idx]], names[entries[1][idx]], float(entries[2][idx]))
+        else:
+            order = numpy.lexsort((entries[0], entries[1]))
+            for idx in order:
+                yield "%s %s %r" % (self.states[entries[1][idx]], names[entries[0][idx]], float(entries[2][idx]))
+
+    def save(self, basename):
+        """writes the model to basename.trans and basename.emit, in the format load() reads"""
+        self._ensure_compiled()
+        for ftype in (".trans", ".emit"):
+            with open(basename + ftype, "w") as f:
+                for line in self._entry_lines(ftype):
+                    f.write(line + "\n")
+
+    @_profiled("load.parse")
+    def _read_text(self, basename):
+        types = (".trans", ".emit")
+        for ftype in types :
+            tdict = defaultdict(dict)
+            path = Path(basename + ftype)
             # Opening the file and iterating through the lines
             with path.open() as f :
                 for line in f :
                     if len(line) != 1 :
                         line = line.split(" ")
                         tdict[line[0]][line[1]] = line[2].rstrip('\n')
-                # Adding to the proper attribute
+                # Adding to the proper attribute (without dropping the compiled arrays)
                 match ftype:
                     case ".trans" :
-                        self.transitions = tdict
+                        self._transitions = tdict
                     case ".emit" :
-                        self.emissions = tdict
-
-    def generate(self, n):
-        """return an n-length Sequence by randomly sampling from this HMM."""
-        #states = list()
-        emissions = list()
-        curr_state = random.choices(list(self.transitions["#"].keys()), [float(item) for item in self.transitions["#"].values()])[0]
-        #states.append(curr_state)
-        for i in range(0, n) :
-            curr_emit = random.choices(list(self.emissions[curr_state].keys()), [float(item) for item in self.emissions[curr_state].values()])[0]
-            emissions.append(curr_emit)
-            curr_state = random.choices(list(self.transitions[curr_state].keys()), [float(item) for item in self.transitions[curr_state].values()])[0]
-            # states.append(curr_state)
-        print(emissions)
-        return emissions
+                        self._emissions = tdict
+        self._basename = basename
+
+    def save_compiled(self, path):
+        """writes the nonzero entries and the state/symbol names to an uncompressed .npz,
+        returns False if it can't be written (e.g. a read-only model directory)"""
+        self._ensure_compiled()
+        symbols = sorted(self.symbol_index, key=self.symbol_index.get)
+        tmp_path = None
+        try:
+            # Writing to a temporary file first so a concurrent load never sees half a cache,
+            # a unique one so two processes saving the same model don't write into each other's
+            fd, tmp_path = tempfile.mkstemp(prefix=Path(path).name + ".", suffix=".tmp", dir=Path(path).parent)
+            with os.fdopen(fd, "wb") as f:
+                numpy.savez(f, version=numpy.array(CACHE_VERSION),
+                            states=numpy.array(self.states, dtype=str),
+                            symbols=numpy.array(symbols, dtype=str),
+                            start_probs=self.start_probs,
+                            trans_from=self._trans_entries[0],
+                            trans_to=self._trans_entries[1],
+                            trans_probs=self._trans_entries[2],
+                            emit_symbols=self._emit_entries[0],
+                            emit_states=self._emit_entries[1],
+                            emit_probs=self._emit_entries[2])
+            os.replace(tmp_path, path)
+        except OSError:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    @_profiled("load.cache")
+    def _load_compiled(self, path):
+        # Returns False for caches written by an older format, or cut short (e.g. by a full
+        # disk), so they get rebuilt
+        try:
+            with numpy.load(path, allow_pickle=False) as arrays:
+                if int(arrays["version"]) != CACHE_VERSION:
+                    return False
+                states = arrays["states"].tolist()
+                symbols = arrays["symbols"].tolist()
+                start_probs = arrays["start_probs"]
+                trans_entries = (arrays["trans_from"], arrays["trans_to"], arrays["trans_probs"])
+                emit_entries = (arrays["emit_symbols"], arrays["emit_states"], arrays["emit_probs"])
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            return False
+        self._set_arrays(states, {symbol: idx for idx, symbol in enumerate(symbols)},
+                         start_probs, trans_entries, emit_entries)
+        return True
+
+    @_profiled("compile")
+    def compile(self):
+        """turns the transition and emission dictionaries into arrays:
+            states       - hidden state names, in transitions order without "#"
+            symbol_index - observation -> symbol number
+            start_probs  - (N,) P(state | "#")
+        and the nonzero transitions/emissions that the engine then lays out as
+            dense:  trans_probs - (N, N) P(state j | state i) at [i, j]
+                    emit_probs  - (V, N) P(symbol | state), one row per symbol so a
+                                  single lookup gives the whole emission column
+            sparse: pred_ptr, pred_states, pred_probs - the predecessors i of state j and
+                                  P(j | i) are at pred_ptr[j]:pred_ptr[j + 1]
+                    emit_ptr, emit_states, emit_values - the states that can emit symbol v
+                                  and P(v | state) are at emit_ptr[v]:emit_ptr[v + 1]"""
+        states = [state for state in self.transitions.keys() if state != "#"]
+        # States that only ever emit are kept too, they just can't be reached
+        states += [state for state in self.emissions.keys() if state not in states]
+        state_index = {state: idx for idx, state in enumerate(states)}
+        symbol_index = {}
+        for emits in self.emissions.values():
+            for symbol in emits:
+                symbol_index.setdefault(symbol, len(symbol_index))
+
+        start_probs = numpy.zeros(len(states))
+        for state, prob in self.transitions.get("#", {}).items():
+            start_probs[state_index[state]] = float(prob)
+        trans_entries = ([], [], [])
+        for state, nexts in self.transitions.items():
+            if state == "#":
+                continue
+            for next_state, prob in nexts.items():
+                if float(prob) > 0:
+                    trans_entries[0].append(state_index[state])
+                    trans_entries[1].append(state_index[next_state])
+                    trans_entries[2].append(float(prob))
+        emit_entries = ([], [], [])
+        for state, emits in self.emissions.items():
+            for symbol, prob in emits.items():
+                if float(prob) > 0:
+                    emit_entries[0].append(symbol_index[symbol])
+                    emit_entries[1].append(state_index[state])
+                    emit_entries[2].append(float(prob))
+        self._set_arrays(states, symbol_index, start_probs,
+                         tuple(numpy.array(column, dtype=dtype) for column, dtype in zip(trans_entries, (numpy.intp, numpy.intp, float))),
+                         tuple(numpy.array(column, dtype=dtype) for column, dtype in zip(emit_entries, (numpy.intp, numpy.intp, float))))
+
+    def _set_arrays(self, states, symbol_index, start_probs, trans_entries, emit_entries):
+        self._reset_compiled()
+        self.states = states
+        self.state_index = {state: idx for idx, state in enumerate(states)}
+        self.symbol_index = symbol_index
+        self.start_probs = start_probs
+        self._trans_entries = trans_entries
+        self._emit_entries = emit_entries
+        # log(0) = -inf marks unreachable transitions and impossible emissions
+        with numpy.errstate(divide="ignore"):
+            self.log_start_probs = numpy.log(start_probs)
+
+    def _ensure_compiled(self):
+        # Builds the arrays the current engine needs, so the engine can be switched after load()
+        if self.states is None:
+            self.compile()
+        if self.engine == "sparse":
+            if self.pred_ptr is None:
+                self._build_sparse()
+        elif self.trans_probs is None:
+            self._build_dense()
+
+    @_profiled("build.dense", _dense_counters)
+    def _build_dense(self):
+        n, v = len(self.states), len(self.symbol_index)
+        trans_from, trans_to, probs = self._trans_entries
+        self.trans_probs = numpy.zeros((n, n))
+        self.trans_probs[trans_from, trans_to] = probs
+        emit_symbols, emit_states, probs = self._emit_entries
+        self.emit_probs = numpy.zeros((v, n))
+        self.emit_probs[emit_symbols, emit_states] = probs
+        # emit_probs with an all-zero row at the end for unknown symbols, see _symbol_rows
+        self._emit_rows = numpy.vstack((self.emit_probs, numpy.zeros(n)))
+        with numpy.errstate(divide="ignore"):
+            self.log_trans_probs = numpy.log(self.trans_probs)
+            self.log_emit_probs = numpy.log(self.emit_probs)
+
+    @_profiled("build.sparse", _sparse_counters)
+    def _build_sparse(self):
+        n, v = len(self.states), len(self.symbol_index)
+        # Grouped by the state moved to, each group ordered by the state moved from
+        trans_from, trans_to, probs = self._trans_entries
+        order = numpy.lexsort((trans_from, trans_to))
+        self.pred_ptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(trans_to, minlength=n))))
+        self.pred_states = trans_from[order]
+        self.pred_probs = probs[order]
+        self.log_pred_probs = numpy.log(self.pred_probs)
+        # Grouped by symbol, each group ordered by state
+        emit_symbols, emit_states, probs = self._emit_entries
+        order = numpy.lexsort((emit_states, emit_symbols))
+        self.emit_ptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(emit_symbols, minlength=v))))
+        self.emit_states = emit_states[order]
+        self.emit_values = probs[order]
+        self.log_emit_values = numpy.log(self.emit_values)
+
+    def _emission(self, symbol):
+        # One row lookup gives P(symbol | state) for every state
+        idx = self.symbol_index.get(symbol)
+        if idx is None:
+            return self._unknown(symbol)[0]
+        return self.emit_probs[idx]
+
+    def _log_emission(self, symbol):
+        idx = self.symbol_index.get(symbol)
+        if idx is None:
+            return self._unknown(symbol)[1]
+        return self.log_emit_probs[idx]
+
+    @staticmethod
+    def word_classes(word):
+        """the classes an unknown word falls into, most specific first: its shape
+        (number, punctuation, hyphenated, capitalized) and its last 3, 2 and 1 letters"""
+        classes = []
+        if any(c.isdigit() for c in word) and all(c.isdigit() or c in ".,-/:" for c in word):
+            classes.append("<number>")
+        elif not any(c.isalnum() for c in word):
+            classes.append("<punctuation>")
+        elif "-" in word:
+            classes.append("<hyphenated>")
+        elif word[:1].isupper():
+            classes.append("<capitalized>")
+        classes += ["-" + word[-length:] for length in (3, 2, 1) if len(word) > length]
+        return classes
+
+    def _build_oov_classes(self, rare_factor=2.0, min_types=5):
+        """estimates P(word class | state) from the rare words of each state, those whose
+        emission probability is at most rare_factor times the state's smallest one (words
+        seen once or twice in the corpus the model came from). Classes with fewer than
+        min_types rare words are left out, "<any>" covers every rare word."""
+        emit_symbols, emit_states, probs = self._emit_entries
+        smallest = numpy.full(len(self.states), numpy.inf)
+        numpy.minimum.at(smallest, emit_states, probs)
+        rare = probs <= rare_factor * smallest[emit_states]
+        symbols = sorted(self.symbol_index, key=self.symbol_index.get)
+        mass = defaultdict(lambda: numpy.zeros(len(self.states)))
+        types = defaultdict(set)
+        for symbol, state, prob in zip(emit_symbols[rare], emit_states[rare], probs[rare]):
+            word = symbols[symbol]
+            for word_class in self.word_classes(word) + ["<any>"]:
+                mass[word_class][state] += prob
+                types[word_class].add(symbol)
+        # Averaged over the class's rare words, so an unknown word gets about the emission of one of them
+        self._oov_classes = {word_class: mass[word_class] / len(types[word_class])
+                             for word_class in mass if len(types[word_class]) >= min_types or word_class == "<any>"}
+
+    def _unknown(self, symbol):
+        """returns P(symbol | state) and its log for a symbol missing from the emissions"""
+        cached = self._oov_cache.get(symbol)
+        if cached is not None:
+            return cached
+        match self.oov:
+            case "zero":
+                emission = numpy.zeros(len(self.states))
+            case "uniform":
+                # As likely as the least likely known emission
+                emission = numpy.full(len(self.states), self._emit_entries[2].min())
+            case "suffix":
+                if self._oov_classes is None:
+                    self._build_oov_classes()
+                emission = next(self._oov_classes[word_class] for word_class in self.word_classes(symbol) + ["<any>"]
+                                if word_class in self._oov_classes)
+            case _:
+                raise ValueError("unknown oov model %s, use zero, uniform or suffix" % self.oov)
+        with numpy.errstate(divide="ignore"):
+            cached = (emission, numpy.log(emission))
+        # Real text has an open vocabulary, so only a bounded number of words are remembered
+        if len(self._oov_cache) < 100000:
+            self._oov_cache[symbol] = cached
+        return cached
+
+    def _candidates(self, symbol):
+        """returns the states that can emit symbol, their (log) emission probabilities, and
+        for each of them the positions of its predecessors in pred_states/pred_probs, flattened,
+        with the candidate each position belongs to"""
+        idx = self.symbol_index.get(symbol)
+        if idx is None:
+            emission, log_emission = self._unknown(symbol)
+            candidates = numpy.flatnonzero(emission)
+            emits, log_emits = emission[candidates], log_emission[candidates]
+        else:
+            lo, hi = self.emit_ptr[idx], self.emit_ptr[idx + 1]
+            candidates = self.emit_states[lo:hi]
+            emits, log_emits = self.emit_values[lo:hi], self.log_emit_values[lo:hi]
+        starts = self.pred_ptr[candidates]
+        lengths = self.pred_ptr[candidates + 1] - starts
+        owner = numpy.repeat(numpy.arange(len(candidates)), lengths)
+        positions = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + numpy.repeat(starts, lengths)
+        return candidates, emits, log_emits, positions, owner
+
+    def _forward_step(self, alpha, symbol):
+        """returns the unnormalized forward vector after symbol given the previous one
+        (None before the first observation)"""
+        if self.engine != "sparse":
+            if alpha is None:
+                return self.start_probs * self._emission(symbol)
+            return (alpha @ self.trans_probs) * self._emission(symbol)
+        candidates, emits, _, positions, owner = self._candidates(symbol)
+        new_alpha = numpy.zeros(len(self.states))
+        if alpha is None:
+            new_alpha[candidates] = self.start_probs[candidates] * emits
+        else:
+            # Only the predecessors of the states that could have emitted symbol are visited
+            incoming = numpy.bincount(owner, weights=alpha[self.pred_states[positions]] * self.pred_probs[positions],
+                                      minlength=len(candidates))
+            new_alpha[candidates] = incoming * emits
+        return new_alpha
+
+    def _forward_scaled(self, sequence):
+        """runs forward keeping alpha normalized to sum to 1 at every step,
+        returns the final (normalized) alpha and log P(sequence), the sum of
+        the logs of the normalizing constants"""
+        loglikelihood = 0.0
+        alpha = None
+        for symbol in sequence:
+            alpha = self._forward_step(alpha, symbol)
+            total = alpha.sum()
+            if total == 0:
+                return alpha, -numpy.inf
+            alpha = alpha / total
+            loglikelihood += numpy.log(total)
+        return alpha, loglikelihood
+
+    def _prune(self, delta):
+        """returns the states kept in the beam (sorted) and delta with every other state set to -inf"""
+        kept = numpy.flatnonzero(delta > -numpy.inf)
+        reachable = len(kept)
+        if self.beam is not None and len(kept) > self.beam:
+            kept = numpy.sort(kept[numpy.argpartition(-delta[kept], self.beam - 1)[:self.beam]])
+        if self.beam_threshold is not None and len(kept):
+            kept = kept[delta[kept] >= delta[kept].max() - self.beam_threshold]
+        if _profiler is not None:
+            _profiler.count("states_pruned", reachable - len(kept))
+        pruned = numpy.full(len(delta), -numpy.inf)
+        pruned[kept] = delta[kept]
+        return kept, pruned
+
+    def _index_dtype(self):
+        # The smallest unsigned type that holds a state number, backpointers are 2 bytes a cell for up to 65536 states
+        return numpy.uint16 if len(self.states) <= 1 << 16 else numpy.uint32
+
+    def _viterbi_log(self, sequence):
+        """viterbi in log space, returns the state indices of the best path and its log probability"""
+        if self.checkpoint:
+            return self._viterbi_checkpoint(sequence)
+        if self.engine == "sparse":
+            return self._viterbi_log_sparse(sequence)
+        if self.beam is not None or self.beam_threshold is not None:
+            return self._viterbi_beam(sequence)
+        columns = numpy.arange(len(self.states))
+        backpointers = numpy.zeros((max(len(sequence) - 1, 0), len(self.states)), dtype=self._index_dtype())
+        delta = self.log_start_probs + self._log_emission(sequence[0])
+        for i, symbol in enumerate(sequence[1:]):
+            scores = delta[:, None] + self.log_trans_probs
+            best = scores.argmax(axis=0)
+            backpointers[i] = best
+            delta = scores[best, columns] + self._log_emission(symbol)
+        state = int(delta.argmax())
+        logprob = float(delta[state])
+        path = [state]
+        for best in backpointers[::-1]:
+            state = int(best[state])
+            path.append(state)
+        path.reverse()
+        return path, logprob
+
+    def _viterbi_first(self, symbol):
+        # The first viterbi column for the sparse and beam/checkpoint decoders
+        if self.engine == "sparse":
+            candidates, _, log_emits, _, _ = self._candidates(symbol)
+            delta = numpy.full(len(self.states), -numpy.inf)
+            delta[candidates] = self.log_start_probs[candidates] + log_emits
+        else:
+            delta = self.log_start_probs + self._log_emission(symbol)
+        if self.beam is not None or self.beam_threshold is not None:
+            delta = self._prune(delta)[1]
+        return delta
+
+    def _viterbi_next(self, delta, symbol):
+        """one viterbi column, returns the backpointers into it and the next delta. The dense
+        engine's backpointers are the best predecessor of every state, the sparse engine's
+        (candidates, best predecessor of each) for just the states that can emit symbol."""
+        beam = self.beam is not None or self.beam_threshold is not None
+        if self.engine == "sparse":
+            candidates, _, log_emits, positions, owner = self._candidates(symbol)
+            new_delta = numpy.full(len(self.states), -numpy.inf)
+            best = numpy.zeros(len(candidates), dtype=self._index_dtype())
+            if len(positions):
+                scores = delta[self.pred_states[positions]] + self.log_pred_probs[positions]
+                # Candidates without predecessors have no group to reduce over
+                reached = numpy.unique(owner)
+                group_starts = numpy.searchsorted(owner, reached)
+                group_max = numpy.maximum.reduceat(scores, group_starts)
+                # The first (lowest numbered) predecessor reaching the max, like argmax in the dense engine
+                is_max = scores == group_max[numpy.searchsorted(reached, owner)]
+                first = numpy.minimum.reduceat(numpy.where(is_max, numpy.arange(len(scores)), len(scores)), group_starts)
+                best[reached] = self.pred_states[positions[numpy.minimum(first, len(scores) - 1)]]
+                new_delta[candidates[reached]] = group_max + log_emits[reached]
+            backpointers = (candidates, best)
+        else:
+            columns = numpy.arange(len(self.states))
+            if beam:
+                # Only the rows of the states in the beam are expanded, each column costs beam * N instead of N * N
+                kept = numpy.flatnonzero(delta > -numpy.inf)
+                if len(kept) == 0:
+                    return numpy.zeros(len(self.states), dtype=self._index_dtype()), delta
+                scores = delta[kept][:, None] + self.log_trans_probs[kept]
+                best = scores.argmax(axis=0)
+                backpointers = kept[best]
+            else:
+                scores = delta[:, None] + self.log_trans_probs
+                best = backpointers = scores.argmax(axis=0)
+            new_delta = scores[best, columns] + self._log_emission(symbol)
+        if beam:
+            new_delta = self._prune(new_delta)[1]
+        return backpointers, new_delta
+
+    def _viterbi_back(self, backpointers, state):
+        # The state before state, from one column of backpointers made by _viterbi_next
+        if self.engine == "sparse":
+            candidates, best = backpointers
+            at = numpy.searchsorted(candidates, state)
+            return int(best[at]) if at < len(candidates) and candidates[at] == state else 0
+        return int(backpointers[state])
+
+    def _viterbi_beam(self, sequence):
+        backpointers = numpy.zeros((max(len(sequence) - 1, 0), len(self.states)), dtype=self._index_dtype())
+        delta = self._viterbi_first(sequence[0])
+        for i, symbol in enumerate(sequence[1:]):
+            backpointers[i], delta = self._viterbi_next(delta, symbol)
+        state = int(delta.argmax())
+        logprob = float(delta[state])
+        path = [state]
+        for best in backpointers[::-1]:
+            state = int(best[state])
+            path.append(state)
+        path.reverse()
+        return path, logprob
+
+    def _viterbi_log_sparse(self, sequence):
+        # Backpointers are only kept for the states that could emit each symbol,
+        # as (candidates, best predecessor of each) sorted by state
+        delta = self._viterbi_first(sequence[0])
+        backpointers = []
+        for symbol in sequence[1:]:
+            column, delta = self._viterbi_next(delta, symbol)
+            backpointers.append(column)
+        state = int(delta.argmax())
+        logprob = float(delta[state])
+        path = [state]
+        for column in reversed(backpointers):
+            state = self._viterbi_back(column, state)
+            path.append(state)
+        path.reverse()
+        return path, logprob
+
+    def _viterbi_checkpoint(self, sequence, segment=None):
+        """exact viterbi in O(N * sqrt(T)) memory instead of O(N * T): a first pass keeps only
+        the delta at the start of every segment (of sqrt(T) observations by default), then the
+        segments are redone last to first, each keeping its own backpointers just long enough to
+        trace the path back through it. Costs about twice the time of a single pass."""
+        length = len(sequence)
+        segment = segment or max(1, math.isqrt(length - 1) + 1)
+        # checkpoints[k] is delta after observation k * segment
+        checkpoints = []
+        delta = self._viterbi_first(sequence[0])
+        for t in range(length):
+            if t:
+                delta = self._viterbi_next(delta, sequence[t])[1]
+            if t % segment == 0:
+                checkpoints.append(delta)
+        state = int(delta.argmax())
+        logprob = float(delta[state])
+        path = numpy.empty(length, dtype=self._index_dtype())
+        path[-1] = state
+        for k in range(len(checkpoints) - 1, -1, -1):
+            first, last = k * segment, min((k + 1) * segment, length - 1)
+            delta = checkpoints[k]
+            checkpoints[k] = None
+            backpointers = []
+            for t in range(first + 1, last + 1):
+                column, delta = self._viterbi_next(delta, sequence[t])
+                backpointers.append(column)
+            for t in range(last, first, -1):
+                state = self._viterbi_back(backpointers[t - first - 1], state)
+                path[t - 1] = state
+        return path, logprob
+
+    @_profiled("log_likelihood", _sequence_counters)
+    def log_likelihood(self, sequence):
+        """returns log P(sequence) under the model, -inf if the sequence is impossible"""
+        self._ensure_compiled()
+        return float(self._forward_scaled(sequence)[1])
+
+    @_profiled("decode", _sequence_counters)
+    def decode(self, sequence):
+        """runs log-space viterbi and returns a Sequence holding the best state path,
+        its log probability and the log-likelihood of the observations"""
+        self._ensure_compiled()
+        if len(sequence) == 0:
+            return Sequence([], [], 0.0, 0.0)
+        path, logprob = self._viterbi_log(sequence)
+        return Sequence([self.states[idx] for idx in path], list(sequence), logprob, self.log_likelihood(sequence))
+
+    def _symbol_rows(self, sequence):
+        # Symbol numbers for a sequence, unknown symbols get the extra all-zero row at the end of _emit_rows
+        unknown = len(self.symbol_index)
+        return numpy.array([self.symbol_index.get(symbol, unknown) for symbol in sequence], dtype=numpy.intp)
+
+    def _forward_backward(self, rows, sequence):
+        """scaled forward-backward over the symbol rows of one sequence, returns
+        alpha, beta (both (T, N), scaled so alpha[t] sums to 1), the scaling
+        constants c (log P(sequence) = sum(log c)) and the emission columns B"""
+        if self.trans_probs is None:
+            self._build_dense()
+        emits = self._emit_rows[rows]
+        if self.oov != "zero":
+            for t in numpy.flatnonzero(rows == len(self.symbol_index)):
+                emits[t] = self._unknown(sequence[t])[0]
+        length = len(rows)
+        alpha = numpy.zeros((length, len(self.states)))
+        scale = numpy.zeros(length)
+        previous = self.start_probs
+        for t in range(length):
+            column = (previous if t == 0 else previous @ self.trans_probs) * emits[t]
+            scale[t] = column.sum()
+            if scale[t] == 0:
+                return alpha, None, scale, emits
+            alpha[t] = previous = column / scale[t]
+        beta = numpy.ones((length, len(self.states)))
+        for t in range(length - 2, -1, -1):
+            beta[t] = self.trans_probs @ (emits[t + 1] * beta[t + 1]) / scale[t + 1]
+        return alpha, beta, scale, emits
+
+    @_profiled("posteriors", _sequence_counters)
+    def posteriors(self, sequence):
+        """returns a (len(sequence), N) array whose row t is P(state at t | whole sequence),
+        columns in self.states order. Rows are all 0 for an impossible sequence."""
+        self._ensure_compiled()
+        if len(sequence) == 0:
+            return numpy.zeros((0, len(self.states)))
+        alpha, beta, scale, emits = self._forward_backward(self._symbol_rows(sequence), sequence)
+        if beta is None:
+            return numpy.zeros((len(sequence), len(self.states)))
+        gamma = alpha * beta
+        return gamma / gamma.sum(axis=1, keepdims=True)
+
+    def expected_counts(self, sequences):
+        """E-step of Baum-Welch over a batch of sequences, returns the expected start,
+        transition (N, N) and emission (V, N) counts, the total log-likelihood and how
+        many sequences were used (impossible ones are skipped)"""
+        self._ensure_compiled()
+        if self.trans_probs is None:
+            self._build_dense()
+        start_counts = numpy.zeros(len(self.states))
+        trans_counts = numpy.zeros_like(self.trans_probs)
+        emit_counts = numpy.zeros((len(self.symbol_index) + 1, len(self.states)))
+        loglikelihood = 0.0
+        used = 0
+        for sequence in sequences:
+            if len(sequence) == 0:
+                continue
+            rows = self._symbol_rows(sequence)
+            alpha, beta, scale, emits = self._forward_backward(rows, sequence)
+            if beta is None:
+                continue
+            gamma = alpha * beta
+            start_counts += gamma[0]
+            # xi summed over t: alpha[t - 1, i] * P(j | i) * P(o_t | j) * beta[t, j] / c_t
+            trans_counts += (alpha[:-1].T @ (emits[1:] * beta[1:] / scale[1:, None])) * self.trans_probs
+            numpy.add.at(emit_counts, rows, gamma)
+            loglikelihood += numpy.log(scale).sum()
+            used += 1
+        return start_counts, trans_counts, emit_counts[:-1], loglikelihood, used
+
+    def baum_welch(self, sequences, iterations=10, tolerance=1e-4, batch_size=1000, jobs=1):
+        """re-estimates the transition and emission probabilities from unlabeled sequences.
+        sequences is a list, or a function returning a fresh iterator over them (e.g.
+        lambda: read_observations("corpus.obs")) so a corpus is streamed once per iteration
+        in batches of batch_size. With jobs > 1 the batches' E-steps run in a process pool.
+        Stops early once the log-likelihood improves by less than tolerance, and returns
+        the log-likelihood of the corpus before each iteration's update."""
+        history = []
+        for _ in range(iterations):
+            corpus = sequences() if callable(sequences) else iter(sequences)
+            batches = iter(lambda: list(itertools.islice(corpus, batch_size)), [])
+            start_counts, trans_counts, emit_counts, loglikelihood, used = 0, 0, 0, 0.0, 0
+            for counts in self._map_counts(batches, jobs):
+                start_counts = start_counts + counts[0]
+                trans_counts = trans_counts + counts[1]
+                emit_counts = emit_counts + counts[2]
+                loglikelihood += counts[3]
+                used += counts[4]
+            if used == 0:
+                raise ValueError("none of the sequences can be produced by this model")
+            history.append(float(loglikelihood))
+            self._maximize(start_counts, trans_counts, emit_counts)
+            if len(history) > 1 and history[-1] - history[-2] < tolerance:
+                break
+        return history
+
+    def _map_counts(self, batches, jobs):
+        if jobs <= 1:
+            for batch in batches:
+                yield self.expected_counts(batch)
+            return
+        self._ensure_compiled()
+        if self.trans_probs is None:
+            self._build_dense()
+        with process_pool(jobs, _init_batch_worker, (self, ())) as pool:
+            yield from pool.imap_unordered(_counts_worker, batches)
 
+    def _maximize(self, start_counts, trans_counts, emit_counts):
+        # M-step, states that were never visited keep their old distributions
+        start_probs = start_counts / start_counts.sum()
+        totals = trans_counts.sum(axis=1, keepdims=True)
+        trans_probs = numpy.where(totals > 0, trans_counts / numpy.where(totals > 0, totals, 1), self.trans_probs)
+        totals = emit_counts.sum(axis=0, keepdims=True)
+        emit_probs = numpy.where(totals > 0, emit_counts / numpy.where(totals > 0, totals, 1), self.emit_probs)
+        trans_from, trans_to = numpy.nonzero(trans_probs)
+        emit_symbols, emit_states = numpy.nonzero(emit_probs)
+        self._set_arrays(self.states, self.symbol_index, start_probs,
+                         (trans_from, trans_to, trans_probs[trans_from, trans_to]),
+                         (emit_symbols, emit_states, emit_probs[emit_symbols, emit_states]))
+        # The dictionaries (and any files) no longer describe this model
+        self._basename = None
+        self._transitions = None
+        self._emissions = None
+        self._ensure_compiled()
 
+    @_profiled("nbest", _sequence_counters)
+    def nbest(self, sequence, k=5):
+        """list viterbi: returns the k most probable state sequences as Sequences with
+        their log probabilities, best first. Every (time, state) keeps its k best partial
+        paths, so this is one pass over the lattice costing k times a viterbi pass."""
+        self._ensure_compiled()
+        if self.trans_probs is None:
+            self._build_dense()
+        if len(sequence) == 0:
+            return []
+        n = len(self.states)
+        # delta[j, r] is the log probability of the r-th best path ending in state j
+        delta = numpy.full((n, k), -numpy.inf)
+        delta[:, 0] = self.log_start_probs + self._log_emission(sequence[0])
+        # backpointers[t, j, r] is i * k + r' for the r'-th best path through state i before it
+        backpointers = numpy.zeros((len(sequence) - 1, n, k), dtype=numpy.intp)
+        for t, symbol in enumerate(sequence[1:]):
+            scores = (delta[:, :, None] + self.log_trans_probs[:, None, :]).reshape(n * k, n)
+            # Stable, so ties go to the lowest numbered state like argmax in viterbi
+            top = numpy.argsort(-scores, axis=0, kind="stable")[:k]
+            backpointers[t] = top.T
+            delta = numpy.take_along_axis(scores, top, axis=0).T + self._log_emission(symbol)[:, None]
+        final = delta.reshape(-1)
+        loglikelihood = self.log_likelihood(sequence)
+        paths = []
+        for flat in numpy.argsort(-final, kind="stable")[:k]:
+            if final[flat] == -numpy.inf:
+                break
+            logprob = float(final[flat])
+            state, rank = divmod(int(flat), k)
+            path = [state]
+            for best in backpointers[::-1]:
+                state, rank = divmod(int(best[state, rank]), k)
+                path.append(state)
+            path.reverse()
+            paths.append(Sequence([self.states[idx] for idx in path], list(sequence), logprob, loglikelihood))
+        return paths
+
+    def confidences(self, sequence, path=None):
+        """returns P(state at t = path[t] | sequence) for each token, the posterior probability
+        that each state of path (by default the viterbi path) is right"""
+        if path is None:
+            path = self.viterbi(sequence)
+        gamma = self.posteriors(sequence)
+        return [float(gamma[t, self.state_index[state]]) for t, state in enumerate(path)]
+
+    def filter(self):
+        """returns a ForwardFilter that tracks this model's state one observation at a time"""
+        self._ensure_compiled()
+        return ForwardFilter(self)
+
+    def forward_batch(self, sequences, jobs=1, chunksize=64):
+        """runs forward on every sequence, returns the most likely final states in order"""
+        return [result[0] for result in self.map_batch(("forward",), sequences, jobs, chunksize)]
+
+    def viterbi_batch(self, sequences, jobs=1, chunksize=64):
+        """runs viterbi on every sequence, returns the state sequences in order"""
+        return [result[0] for result in self.map_batch(("viterbi",), sequences, jobs, chunksize)]
+
+    def map_batch(self, methods, sequences, jobs=1, chunksize=64):
+        """yields a tuple with the result of each named method (e.g. ("forward", "log_likelihood"),
+        or ("nbest", {"k": 3}) to pass keyword arguments) for every sequence, in the order the
+        sequences come in. With jobs > 1 the sequences
+        are sent to a pool of processes that each hold a read-only copy of this model."""
+        for sequence, results in self._map_sequences(methods, sequences, jobs, chunksize):
+            yield results
+
+    def _map_sequences(self, methods, sequences, jobs=1, chunksize=64):
+        # map_batch, yielding (sequence, results) pairs so callers don't have to keep the input
+        if self.engine != "dict":
+            self._ensure_compiled()
+        if jobs <= 1:
+            for sequence in sequences:
+                yield sequence, tuple(_call(self, method, sequence) for method in methods)
+            return
+        # imap's feeder thread would read the whole input ahead of the workers, so the pool
+        # is given a block at a time, with the next block queued while this one is yielded
+        sequences = iter(sequences)
+        blocks = iter(lambda: list(itertools.islice(sequences, jobs * chunksize * 2)), [])
+        with process_pool(jobs, _init_batch_worker, (self, methods)) as pool:
+            pending = None
+            for block in blocks:
+                results = pool.imap(_batch_worker, block, chunksize)
+                if pending is not None:
+                    yield from pending
+                pending = results
+            if pending is not None:
+                yield from pending
+
+    def _build_sampler(self):
+        """precomputes the cumulative distributions generate() samples from: the start
+        state, the successors of each state (as lists, for bisect in the state loop)
+        and the symbols each state emits (as arrays, for searchsorted over a whole chunk)"""
+        def cumulative(probs):
+            cdf = numpy.cumsum(probs) / probs.sum()
+            cdf[-1] = 1.0
+            return cdf
+
+        n = len(self.states)
+        self._start_cdf = cumulative(self.start_probs).tolist()
+        trans_from, trans_to, probs = self._trans_entries
+        self._successors = []
+        self._successor_cdfs = []
+        for state in range(n):
+            rows = numpy.flatnonzero(trans_from == state)
+            # A state without transitions out keeps the chain where it is
+            if len(rows) == 0:
+                self._successors.append([state])
+                self._successor_cdfs.append([1.0])
+                continue
+            self._successors.append(trans_to[rows].tolist())
+            self._successor_cdfs.append(cumulative(probs[rows]).tolist())
+        emit_symbols, emit_states, probs = self._emit_entries
+        self._emitted = []
+        self._emitted_cdfs = []
+        for state in range(n):
+            rows = numpy.flatnonzero(emit_states == state)
+            self._emitted.append(emit_symbols[rows])
+            self._emitted_cdfs.append(cumulative(probs[rows]) if len(rows) else numpy.ones(0))
+        self._symbol_names = numpy.array(sorted(self.symbol_index, key=self.symbol_index.get), dtype=object)
+
+    def sample(self, n, rng=None, chunk=100000):
+        """yields Sequences that together hold n observations (and the states that emitted them)
+        sampled from this HMM, at most chunk at a time so any n fits in memory.
+        rng is a numpy Generator or a seed, the chain carries on from one chunk to the next."""
+        self._ensure_compiled()
+        if self._symbol_names is None:
+            self._build_sampler()
+        rng = numpy.random.default_rng(rng)
+        state = None
+        while n > 0:
+            size = min(n, chunk)
+            n -= size
+            # State path first, it is the only part that has to be a loop
+            uniforms = rng.random(size).tolist()
+            path = numpy.empty(size, dtype=numpy.intp)
+            for i, u in enumerate(uniforms):
+                if state is None:
+                    state = bisect.bisect_right(self._start_cdf, u)
+                else:
+                    successors = self._successors[state]
+                    state = successors[min(bisect.bisect_right(self._successor_cdfs[state], u), len(successors) - 1)]
+                path[i] = state
+            # then every emission of each state in one searchsorted
+            symbols = numpy.empty(size, dtype=numpy.intp)
+            uniforms = rng.random(size)
+            for emitter in numpy.unique(path):
+                rows = numpy.flatnonzero(path == emitter)
+                picks = numpy.searchsorted(self._emitted_cdfs[emitter], uniforms[rows], side="right")
+                symbols[rows] = self._emitted[emitter][numpy.minimum(picks, len(self._emitted[emitter]) - 1)]
+            yield Sequence([self.states[idx] for idx in path], self._symbol_names[symbols].tolist())
+
+    def generate(self, n, seed=None, states=False):
+        """return n observations randomly sampled from this HMM, or a Sequence that
+        also holds the hidden states if states is set. seed makes the result repeatable."""
+        stateseq = []
+        outputseq = []
+        for sequence in self.sample(n, seed):
+            stateseq += sequence.stateseq
+            outputseq += sequence.outputseq
+        if states :
+            return Sequence(stateseq, outputseq)
+        return outputseq
+
+    def write_generated(self, file, n, seed=None, states=False, per_line=100000):
+        """streams n sampled observations into file, per_line on each line. With states set
+        each line of observations comes after a line with their hidden states, the same
+        layout as ambiguous_sents.tagged.obs."""
+        with open(file, 'w') as f :
+            for sequence in self.sample(n, seed, per_line) :
+                if states :
+                    f.write(" ".join(sequence.stateseq) + "\n")
+                f.write(" ".join(sequence.outputseq) + "\n")
+
+    @_profiled("forward", _sequence_counters)
     def forward(self, sequence):
+        """returns the most likely final state for a sequence of observations"""
+        if self.engine == "dict":
+            return self._forward_dict(sequence)
+        self._ensure_compiled()
+        if len(sequence) == 0:
+            return "#"
+        if self.logspace or self.engine == "sparse":
+            alpha, loglikelihood = self._forward_scaled(sequence)
+            if loglikelihood == -numpy.inf:
+                return "#"
+            return self.states[int(alpha.argmax())]
+        alpha = self.start_probs * self._emission(sequence[0])
+        for symbol in sequence[1:]:
+            # alpha[j] = sum_i alpha[i] * P(j | i) * P(symbol | j)
+            alpha = (alpha @ self.trans_probs) * self._emission(symbol)
+        # Like the dict engine, no reachable state leaves us at the start state
+        if not alpha.any():
+            return "#"
+        return self.states[int(alpha.argmax())]
+
+    def _forward_dict(self, sequence):
         # Initializing a matrix with sequence + 1 columns to account for sequence and "-"
         # and with transitions["#"].keys() rows to account for all states, including "#"
         matrix = [[float(0) for j in range(len(sequence) + 1)] for i in range(len(self.transitions.keys()))]
@@ -115,7 +1154,34 @@ class HMM:
                 max_idx = idx
         return list(self.transitions.keys())[max_idx]
 
+    @_profiled("viterbi", _sequence_counters)
     def viterbi(self, sequence):
+        """returns the most likely sequence of hidden states for a sequence of observations"""
+        if self.engine == "dict":
+            return self._viterbi_dict(sequence)
+        self._ensure_compiled()
+        if len(sequence) == 0:
+            return []
+        if self.logspace or self.engine == "sparse" or self.beam is not None or self.beam_threshold is not None or self.checkpoint:
+            return [self.states[idx] for idx in self._viterbi_log(sequence)[0]]
+        columns = numpy.arange(len(self.states))
+        backpointers = numpy.zeros((len(sequence) - 1, len(self.states)), dtype=self._index_dtype())
+        delta = self.start_probs * self._emission(sequence[0])
+        for i, symbol in enumerate(sequence[1:]):
+            # scores[i, j] = delta[i] * P(j | i), best predecessor of j is the max down column j
+            scores = delta[:, None] * self.trans_probs
+            best = scores.argmax(axis=0)
+            backpointers[i] = best
+            delta = scores[best, columns] * self._emission(symbol)
+        state = int(delta.argmax())
+        path = [state]
+        for best in backpointers[::-1]:
+            state = int(best[state])
+            path.append(state)
+        path.reverse()
+        return [self.states[idx] for idx in path]
+
+    def _viterbi_dict(self, sequence):
         # Initializing a matrix with sequence + 1 columns to account for sequence and #
         # and with transitions["#"].keys() + 1 rows to account for starting states and "#"
         matrix = [[float(0) for j in range(len(sequence) + 1)] for i in range(len(self.transitions.keys()))]
@@ -151,56 +1217,336 @@ class HMM:
                             backpointers[idx1][i] = idx2
                     matrix[idx1][i] = max_prob
         states = []
-        min_value = float("inf")
-        min_row = -1
         last_column = len(matrix[0]) - 1
-        # Finds the initial minimum value from the last column
-        for idx, row in enumerate(backpointers[1:]):
-            if (row[last_column] != 0) and row[last_column] < min_value:
-                min_value = row[last_column]
-                min_row = idx + 1
-        # Both value and row get added because value doesn't give us which row the last value occurred at
-        states.append(min_row)
-        states.append(int(min_value))
-        # Iterates backwards using the min_value we found to backtrace the indices
+        # The path ends in the most probable state of the last column ("#" never is, its row is 0 there)
+        max_row = 1
+        for idx, row in enumerate(matrix[1:]):
+            if row[last_column] > matrix[max_row][last_column]:
+                max_row = idx + 1
+        states.append(max_row)
+        # Iterates backwards following the backpointers from that state
         while last_column > 1:
+            max_row = int(backpointers[max_row][last_column])
+            states.append(max_row)
             last_column -= 1
-            min_value = int(backpointers[int(min_value)][last_column])
-            states.append(min_value)
         states.reverse()
         emits = []
-        # Ignoring the 0 as it tells us nothing, the entire first (second(?)) row is all zeros
-        for state in states[1:] :
+        for state in states :
             emits.append(list(self.transitions.keys())[state])
         return emits
 
+# ForwardFilter - online version of the forward algorithm, it keeps only the
+# current (normalized) belief over the states and updates it per observation
+
+class ForwardFilter:
+    def __init__(self, hmm):
+        self.hmm = hmm
+        self.reset()
+
+    def reset(self):
+        """forgets every observation, the next one is treated as the first"""
+        self.belief = None          # P(state | observations so far), sums to 1
+        self.loglikelihood = 0.0    # log P(observations so far)
+        self.steps = 0
+
+    def update(self, symbol):
+        """folds in one observation and returns the most likely current state"""
+        belief = self.hmm._forward_step(self.belief, symbol)
+        total = belief.sum()
+        self.steps += 1
+        if total == 0:
+            # No state could have produced this, same as forward() the filter is stuck at "#"
+            self.belief = belief
+            self.loglikelihood = -numpy.inf
+        else:
+            self.belief = belief / total
+            self.loglikelihood += numpy.log(total)
+        return self.most_likely_state()
+
+    def run(self, observations):
+        """yields the most likely current state after each observation from an iterable/generator"""
+        for symbol in observations:
+            yield self.update(symbol)
+
+    def most_likely_state(self):
+        if self.belief is None or not self.belief.any():
+            return "#"
+        return self.hmm.states[int(self.belief.argmax())]
+
+    def probability(self, states):
+        """returns the probability that the current state is one of states"""
+        if self.belief is None:
+            return 0.0
+        rows = [self.hmm.state_index[state] for state in states if state in self.hmm.state_index]
+        return float(self.belief[rows].sum())
+
+    def safe_land_probability(self):
+        return self.probability(SAFE_LANDING)
+
+# TagCounter - counts tag transitions and tag/word emissions from a tagged corpus
+# in integer arrays that grow with the tag set and vocabulary, never with the corpus
+
+class TagCounter:
+    def __init__(self):
+        self.tags = {}
+        self.words = {}
+        self.start_counts = numpy.zeros(16, dtype=numpy.int64)
+        self.trans_counts = numpy.zeros((16, 16), dtype=numpy.int64)
+        self.emit_counts = numpy.zeros((1024, 16), dtype=numpy.int64)
+        # Token indices waiting to be added to the arrays, flushed every flush_size tokens
+        self.flush_size = 100000
+        self._pending = ([], [], [], [], [])
+
+    def _index(self, names, name):
+        idx = names.get(name)
+        if idx is None:
+            idx = names[name] = len(names)
+        return idx
+
+    def add(self, tags, words):
+        """counts one tagged sentence"""
+        # A pair of lines that don't line up only counts as far as both go
+        length = min(len(tags), len(words))
+        tag_rows = [self._index(self.tags, tag) for tag in tags[:length]]
+        word_rows = [self._index(self.words, word) for word in words[:length]]
+        if not tag_rows:
+            return
+        starts, trans_from, trans_to, emit_words, emit_tags = self._pending
+        starts.append(tag_rows[0])
+        trans_from += tag_rows[:-1]
+        trans_to += tag_rows[1:]
+        emit_words += word_rows
+        emit_tags += tag_rows
+        if len(emit_words) >= self.flush_size:
+            self.flush()
+
+    def update(self, pairs):
+        """counts every (tags, words) pair, e.g. from read_tagged(file)"""
+        for tags, words in pairs:
+            self.add(tags, words)
+        self.flush()
+        return self
+
+    def _grow(self):
+        # Doubling so growing is amortized O(1) per new tag or word
+        n, v = self.trans_counts.shape[0], self.emit_counts.shape[0]
+        while n < len(self.tags):
+            n *= 2
+        while v < len(self.words):
+            v *= 2
+        if n != self.trans_counts.shape[0] or v != self.emit_counts.shape[0]:
+            start_counts = numpy.zeros(n, dtype=numpy.int64)
+            start_counts[:len(self.start_counts)] = self.start_counts
+            trans_counts = numpy.zeros((n, n), dtype=numpy.int64)
+            trans_counts[:self.trans_counts.shape[0], :self.trans_counts.shape[1]] = self.trans_counts
+            emit_counts = numpy.zeros((v, n), dtype=numpy.int64)
+            emit_counts[:self.emit_counts.shape[0], :self.emit_counts.shape[1]] = self.emit_counts
+            self.start_counts, self.trans_counts, self.emit_counts = start_counts, trans_counts, emit_counts
+
+    def flush(self):
+        self._grow()
+        starts, trans_from, trans_to, emit_words, emit_tags = self._pending
+        self.start_counts += numpy.bincount(starts, minlength=len(self.start_counts)).astype(numpy.int64)
+        numpy.add.at(self.trans_counts, (numpy.array(trans_from, dtype=numpy.intp), numpy.array(trans_to, dtype=numpy.intp)), 1)
+        numpy.add.at(self.emit_counts, (numpy.array(emit_words, dtype=numpy.intp), numpy.array(emit_tags, dtype=numpy.intp)), 1)
+        self._pending = ([], [], [], [], [])
+
+    def merge(self, other):
+        """adds the counts of another TagCounter (e.g. from another shard of the corpus)"""
+        other.flush()
+        self.flush()
+        tag_map = numpy.array([self._index(self.tags, tag) for tag in other.tags], dtype=numpy.intp)
+        word_map = numpy.array([self._index(self.words, word) for word in other.words], dtype=numpy.intp)
+        self._grow()
+        n, v = len(other.tags), len(other.words)
+        numpy.add.at(self.start_counts, tag_map, other.start_counts[:n])
+        self.trans_counts[numpy.ix_(tag_map, tag_map)] += other.trans_counts[:n, :n]
+        self.emit_counts[numpy.ix_(word_map, tag_map)] += other.emit_counts[:v, :n]
+        return self
+
+    def to_hmm(self, smoothing=1.0, emission_smoothing=0.0, **options):
+        """returns the HMM with additively smoothed relative frequencies: smoothing is added
+        to every start and transition count, emission_smoothing to every tag/word count
+        (0 keeps the emissions to the pairs seen, unknown words are left to the decoder)"""
+        self.flush()
+        n, v = len(self.tags), len(self.words)
+        start = self.start_counts[:n] + smoothing
+        trans = self.trans_counts[:n, :n] + smoothing
+        emit = self.emit_counts[:v, :n] + emission_smoothing
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            start_probs = start / start.sum()
+            trans_probs = numpy.nan_to_num(trans / trans.sum(axis=1, keepdims=True))
+            emit_probs = numpy.nan_to_num(emit / emit.sum(axis=0, keepdims=True))
+        return HMM.from_probabilities(list(self.tags), list(self.words), start_probs, trans_probs, emit_probs, **options)
+
+def train_tagged(files, smoothing=1.0, emission_smoothing=0.0, **options) :
+    """trains an HMM from tagged files (tag line, then word line, like ambiguous_sents.tagged.obs),
+    streaming them a line at a time"""
+    counter = TagCounter()
+    for file in ([files] if isinstance(files, str) else files) :
+        counter.update(read_tagged(file))
+    return counter.to_hmm(smoothing, emission_smoothing, **options)
+
+# The model each batch worker process decodes with, set once when the pool starts
+_worker_model = None
+_worker_methods = ()
+
+def _init_batch_worker(model, methods) :
+    global _worker_model, _worker_methods
+    _worker_model = model
+    _worker_methods = methods
+
+def _call(model, method, sequence) :
+    # method is a method name, or a (name, keyword arguments) pair
+    if isinstance(method, str) :
+        return getattr(model, method)(sequence)
+    name, kwargs = method
+    return getattr(model, name)(sequence, **kwargs)
+
+def _batch_worker(sequence) :
+    # The sequence goes back with its results so the caller needn't hold on to the input
+    return sequence, tuple(_call(_worker_model, method, sequence) for method in _worker_methods)
+
+def _counts_worker(batch) :
+    return _worker_model.expected_counts(batch)
+
+# The lander grid cells marked X in landermap.docx
+SAFE_LANDING = ["4,3", "4,4", "3,4", "2,5"]
+
 def safe_land(state) :
-    return state in ["4,3", "4,4", "3,4", "2,5"]
+    return state in SAFE_LANDING
+
+def stream_tokens(file) :
+    """yields the observations in a file (or stdin for "-") one at a time, as soon as each line arrives"""
+    f = sys.stdin if file == "-" else open(file)
+    try :
+        for line in f :
+            yield from line.split()
+    finally :
+        if f is not sys.stdin :
+            f.close()
 
-def run(basename, file, type) :
-    h = HMM()
+def run_filter(basename, file, **options) :
+    """prints the most likely current state after each observation in file (or stdin
+    for "-") as it arrives, options are passed on to HMM like in run()"""
+    h = HMM(**options)
     h.load(basename)
-    if not Path(file).is_file() :
-        with open(file, 'w') as f:
-            toks = " ".join(h.generate(20))
-            f.write(toks)
+    tracker = h.filter()
+    for symbol in stream_tokens(file) :
+        print("After observing %s the most likely current state is %s" % (symbol, tracker.update(symbol)))
+        if basename == "lander" :
+            print("The probability it is safe for the lander to land is %.4f" % tracker.safe_land_probability())
+        sys.stdout.flush()
+
+def read_observations(file, document=False) :
+    """yields the token lists in an observation file, one per non-empty line,
+    or a single list with every token in the file if document is set"""
     with open(file) as f :
+        if document :
+            yield f.read().split()
+            return
         for line in f :
             if len(line) != 1 :
                 lines = line.split(" ")
-                tokens = [item.rstrip('\n') for item in lines if item != ('' or '\n')]
-                match type :
-                    case "forward" :
-                        print(f"The most likely current state is %s" % h.forward(tokens))
-                    case "viterbi" :
-                        likely_states = h.viterbi(tokens)
-                        print(f"The most likely sequence of hidden states for the sequence of observations \"%s\" is \"%s\"" % (" ".join(tokens), " ".join(likely_states)))
-                        if basename == "lander" :
-                            if safe_land(likely_states[-1]) :
-                                print("It it safe for the lander to land")
-                            else :
-                                print("It is not safe for the lander to land")
+                yield [item.rstrip('\n') for item in lines if item != ('' or '\n')]
+
+def read_tagged(file) :
+    """yields (tags, words) for each pair of lines in a tagged observation file,
+    the tag line comes first, e.g. ambiguous_sents.tagged.obs"""
+    with open(file) as f :
+        lines = (line.split() for line in f if line.strip())
+        for tags in lines :
+            words = next(lines, None)
+            if words is None :
+                return
+            yield tags, words
+
+def beam_report(basename, tagged_file, widths=(1, 2, 4, 8), repeat=20, engine="dense") :
+    """decodes a tagged file with exact viterbi and with each beam width, and returns
+    one dict per decoder with its tag accuracy, how many tags agree with exact viterbi,
+    and the time to decode the file repeat times"""
+    sentences = list(read_tagged(tagged_file))
+    report = []
+    exact_paths = None
+    for width in (None,) + tuple(widths) :
+        h = HMM(engine=engine, logspace=True, beam=width)
+        h.load(basename)
+        start = time.perf_counter()
+        for _ in range(repeat) :
+            paths = [h.viterbi(words) for tags, words in sentences]
+        seconds = time.perf_counter() - start
+        if exact_paths is None :
+            exact_paths = paths
+        total = sum(len(tags) for tags, words in sentences)
+        correct = sum(t == p for (tags, words), path in zip(sentences, paths) for t, p in zip(tags, path))
+        agree = sum(e == p for exact_path, path in zip(exact_paths, paths) for e, p in zip(exact_path, path))
+        report.append({"beam" : width, "accuracy" : correct / total, "agreement" : agree / total,
+                       "seconds" : seconds, "speedup" : report[0]["seconds"] / seconds if report else 1.0})
+    return report
+
+def run(basename, file, type, document=False, jobs=1, nbest=None, confidence=False, **options) :
+    """decodes every line of file (or the whole file with document set), options
+    are passed on to HMM, e.g. engine="sparse", logspace=True or beam=4. For viterbi,
+    nbest also lists the nbest most likely state sequences and confidence prints the
+    posterior probability of each decoded state."""
+    h = HMM(**options)
+    h.load(basename)
+    logspace = h.logspace
+    if not Path(file).is_file() :
+        with open(file, 'w') as f:
+            toks = " ".join(h.generate(20))
+            f.write(toks)
+    match type :
+        case "forward" :
+            methods = ("forward", "log_likelihood") if logspace else ("forward",)
+        case "viterbi" :
+            methods = ("decode",) if logspace else ("viterbi",)
+            if nbest :
+                methods += (("nbest", {"k" : nbest}),)
+            if confidence :
+                methods += ("confidences",)
+    # Lines are decoded in parallel with --jobs but always printed in file order
+    for tokens, results in h._map_sequences(methods, read_observations(file, document), jobs) :
+        match type :
+            case "forward" :
+                print(f"The most likely current state is %s" % results[0])
+                if logspace :
+                    print("The log-likelihood of the observations is %f" % results[1])
+            case "viterbi" :
+                if logspace :
+                    decoded = results[0]
+                    likely_states = decoded.stateseq
+                else :
+                    likely_states = results[0]
+                print(f"The most likely sequence of hidden states for the sequence of observations \"%s\" is \"%s\"" % (" ".join(tokens), " ".join(likely_states)))
+                if logspace :
+                    print("The log probability of that sequence is %f and the log-likelihood of the observations is %f" % (decoded.logprob, decoded.loglikelihood))
+                if nbest :
+                    print("The %d most likely sequences of hidden states are:" % nbest)
+                    for rank, sequence in enumerate(results[1], 1) :
+                        print("  %d. %s (log probability %f)" % (rank, " ".join(sequence.stateseq), sequence.logprob))
+                if confidence :
+                    print("The posterior probability of each state is: %s" % " ".join(
+                        "%s/%s(%.3f)" % (token, state, prob) for token, state, prob in zip(tokens, likely_states, results[-1])))
+                if basename == "lander" :
+                    if safe_land(likely_states[-1]) :
+                        print("It it safe for the lander to land")
+                    else :
+                        print("It is not safe for the lander to land")
+
+def positive_int(text) :
+    """argparse type for counts that must be at least 1"""
+    value = int(text)
+    if value < 1 :
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % text)
+    return value
 
+def non_negative_float(text) :
+    """argparse type for thresholds that can't be negative"""
+    value = float(text)
+    if value < 0 :
+        raise argparse.ArgumentTypeError("%s is negative" % text)
+    return value
 
 if __name__ == "__main__" :
     # when moving to submission.py it'll look like HMM.HMM()
@@ -209,18 +1555,75 @@ if __name__ == "__main__" :
                     description = 'Performs Hidden Markov Models on a sequence of states')
     parser.add_argument('basename', help = "The basename of the .emit and .trans file to process")
     parser.add_argument('--generate', metavar = "N", help = "Generates a random sequence with N random observations")
+    parser.add_argument('--seed', metavar = "S", type = int, help = "Seeds the random number generator used by --generate")
+    parser.add_argument('--states', action = "store_true", help = "With --generate, writes the hidden states on a line before each line of observations")
+    parser.add_argument('--output', metavar = "file", help = "With --generate, the file to write to instead of <basename>_sequence.obs")
     parser.add_argument('--forward', metavar = "outfile", help = "Runs the Forward Algorithm on the observations in this file, if given a file that doesn't exist, will create one with default 20 observations")
     parser.add_argument('--viterbi', metavar = "outfile", help = "Runs the Viterbi Algorithm on the observations in this file, if given a file that doesn't exist, will create one with default 20 observations")
+    parser.add_argument('--engine', choices = ["dense", "sparse", "dict"], default = "dense", help = "Runs Forward/Viterbi over compiled NumPy arrays (dense), predecessor lists for large sparse models (sparse) or the original dictionary loops (dict)")
+    parser.add_argument('--logspace', action = "store_true", help = "Runs Forward/Viterbi with log/normalized probabilities so long sequences don't underflow, also prints log-likelihoods")
+    parser.add_argument('--checkpoint', action = "store_true", help = "Runs an exact log-space Viterbi that keeps only about sqrt(T) lattice columns in memory, for very long sequences (about twice as slow)")
+    parser.add_argument('--document', action = "store_true", help = "Decodes every token in the observation file as a single sequence instead of line by line")
+    parser.add_argument('--beam', metavar = "K", type = positive_int, help = "Keeps only the K most probable states per observation in Viterbi (approximate)")
+    parser.add_argument('--beam-threshold', metavar = "LOGP", type = non_negative_float, help = "Keeps only the states within LOGP log probability of the best per observation in Viterbi (approximate)")
+    parser.add_argument('--beam-report', metavar = "taggedfile", help = "Compares the accuracy and speed of beam Viterbi against exact Viterbi on a tagged file like ambiguous_sents.tagged.obs")
+    parser.add_argument('--baum-welch', metavar = "obsfile", help = "Re-estimates the model from the unlabeled observations in this file (one sequence per line)")
+    parser.add_argument('--iterations', metavar = "N", type = int, default = 10, help = "The most Baum-Welch iterations to run")
+    parser.add_argument('--save', metavar = "basename", help = "Writes the re-estimated (--baum-welch) or trained (--train-tagged) model to this basename's .trans and .emit files")
+    parser.add_argument('--force', action = "store_true", help = "Lets --save overwrite existing .trans and .emit files")
+    parser.add_argument('--train-tagged', metavar = "taggedfile", nargs = "+", help = "Trains a model on these tagged files, written out with --save")
+    parser.add_argument('--smoothing', metavar = "K", type = float, default = 1.0, help = "With --train-tagged, added to every start and transition count")
+    parser.add_argument('--emission-smoothing', metavar = "K", type = float, default = 0.0, help = "With --train-tagged, added to every tag/word count")
+    parser.add_argument('--oov', choices = ["zero", "uniform", "suffix"], default = "zero", help = "How words missing from the .emit file are handled: emitted by no state (zero), by every state equally (uniform) or like known words with the same shape/suffix (suffix)")
+    parser.add_argument('--nbest', metavar = "K", type = positive_int, help = "With --viterbi, also lists the K most likely sequences of hidden states")
+    parser.add_argument('--confidence', action = "store_true", help = "With --viterbi, also prints the posterior probability of each decoded state")
+    parser.add_argument('--jobs', metavar = "N", type = int, default = 1, help = "Decodes the lines of the observation file across N processes")
+    parser.add_argument('--profile', metavar = "file", help = "Times each phase of loading and decoding (in this process, not --jobs workers), prints a summary and writes the details to this file")
+    parser.add_argument('--profile-format', choices = ["json", "chrome"], default = "json", help = "With --profile, writes a JSON summary and event list (json) or a trace for chrome://tracing or Perfetto (chrome)")
+    parser.add_argument('--filter', metavar = "file", help = "Tracks the most likely current state after every observation in this file as it is read, use - for stdin")
     args = parser.parse_args()
 
+    if args.train_tagged and not args.save :
+        parser.error("--train-tagged needs --save BASENAME to write the trained model to")
+    # Checked before training so a long run isn't thrown away, and so the shipped
+    # models aren't overwritten by accident
+    if args.save and not args.force :
+        for ftype in (".trans", ".emit") :
+            if Path(args.save + ftype).exists() :
+                parser.error("%s already exists, use --force to overwrite it" % (args.save + ftype))
+
+    if args.profile :
+        profile = Profiler().start()
+    if args.train_tagged :
+        train_tagged(args.train_tagged, args.smoothing, args.emission_smoothing).save(args.save)
+        print("Wrote %s.trans and %s.emit" % (args.save, args.save))
+    options = dict(engine = args.engine, logspace = args.logspace, beam = args.beam, beam_threshold = args.beam_threshold, oov = args.oov, checkpoint = args.checkpoint)
     if args.forward :
-        run(args.basename, args.forward, "forward")
+        run(args.basename, args.forward, "forward", args.document, args.jobs, **options)
     if args.viterbi :
-        run(args.basename, args.viterbi, "viterbi")
+        run(args.basename, args.viterbi, "viterbi", args.document, args.jobs, args.nbest, args.confidence, **options)
+    if args.beam_report :
+        print("beam  accuracy  agreement  seconds  speedup")
+        for row in beam_report(args.basename, args.beam_report, engine = args.engine if args.engine != "dict" else "dense") :
+            print("%-5s %8.3f %10.3f %8.4f %8.2f" % (row["beam"] or "exact", row["accuracy"], row["agreement"], row["seconds"], row["speedup"]))
+    if args.baum_welch :
+        h = HMM()
+        h.load(args.basename)
+        history = h.baum_welch(lambda: read_observations(args.baum_welch), args.iterations, jobs = args.jobs)
+        for iteration, loglikelihood in enumerate(history) :
+            print("Iteration %d: the log-likelihood of the observations is %f" % (iteration + 1, loglikelihood))
+        if args.save :
+            h.save(args.save)
+            print("Wrote %s.trans and %s.emit" % (args.save, args.save))
+    if args.filter :
+        run_filter(args.basename, args.filter, **options)
     if args.generate :
         h = HMM()
-        with open(args.basename + "_sequence.obs", 'w') as f :
-            h.load(args.basename)
-            tokens = " ".join(h.generate(int(args.generate)))
-            f.write(tokens)
-
+        h.load(args.basename)
+        outfile = args.output or args.basename + "_sequence.obs"
+        h.write_generated(outfile, int(args.generate), args.seed, args.states)
+        print("Wrote %s random observations to %s" % (args.generate, outfile))
+    if args.profile :
+        profile.stop()
+        profile.save(args.profile, args.profile_format)
+        print(profile.report(), file=sys.stderr)
@@ -1,6 +1,8 @@
 from pgmpy.models import BayesianNetwork
 from pgmpy.inference import VariableElimination
 
+from bn_inference import CompiledInference
+
 alarm_model = BayesianNetwork(
     [
         ("Burglary", "Alarm"),
@@ -51,6 +53,7 @@ alarm_model.add_cpds(
     cpd_burglary, cpd_earthquake, cpd_alarm, cpd_johncalls, cpd_marycalls)
 
 alarm_infer = VariableElimination(alarm_model)
+alarm_compiled = CompiledInference(alarm_model)
 
 if  __name__ == '__main__' :
     print("The probability JohnCalls given an Earthquake")
@@ -0,0 +1,270 @@
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+# Benchmark suite - times the HMM, Bayesian network and decision tree workloads
+# in this repo, writes the results as JSON and compares them to a stored baseline.
+#
+#     python benchmark.py                      # run everything, compare to benchmark_baseline.json
+#     python benchmark.py --only hmm --quick   # just the HMM cases, shorter sequences
+#     python benchmark.py --only startup       # interpreter + import + CLI start up times
+#     python benchmark.py --save-baseline      # make this run the new baseline
+
+BASELINE = "benchmark_baseline.json"
+HERE = Path(__file__).resolve().parent
+MODELS = ("cat", "lander", "partofspeech")
+ENGINES = ("dense", "sparse")
+
+
+def timed(fn, repeat, min_time=0.02):
+    """returns the min/median wall time of one call to fn in seconds, over repeat
+    timings that each loop over fn enough times to take at least min_time"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_time:
+            break
+        number *= 2
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat, "number": number}
+
+
+def calibration():
+    """a fixed mix of interpreter work and small NumPy calls, like most of the cases,
+    timed throughout each run so the cases can be compared as multiples of its median
+    rather than in seconds that depend on the machine and whatever else is running on it"""
+    import numpy
+    x = numpy.ones(64)
+    m = numpy.full((64, 64), 1 / 64)
+    totals = {}
+    for i in range(1000):
+        x = m @ x
+        totals[i % 7] = totals.get(i % 7, 0) + x[i % 64]
+    return totals
+
+
+def synthetic(h, n, seed=0):
+    """returns n observations sampled from h, the same ones every run"""
+    return h.generate(n, seed=seed)
+
+
+def hmm_cases(lengths):
+    from HMM import HMM
+
+    for basename in MODELS:
+        # Makes sure the compiled cache exists so the cached case never parses text
+        HMM().load(basename)
+        yield "hmm.load.%s.text" % basename, lambda basename=basename: HMM().load(basename, cache=False)
+        yield "hmm.load.%s.cached" % basename, lambda basename=basename: HMM().load(basename)
+        for engine in ENGINES:
+            h = HMM(engine=engine)
+            h.load(basename)
+            for n in lengths:
+                sequence = synthetic(h, n)
+                yield "hmm.forward.%s.%s.n%d" % (basename, engine, n), lambda h=h, s=sequence: h.forward(s)
+                yield "hmm.viterbi.%s.%s.n%d" % (basename, engine, n), lambda h=h, s=sequence: h.viterbi(s)
+        # Memory-bounded viterbi, recomputing each segment of the lattice on the way back
+        h = HMM(checkpoint=True)
+        h.load(basename)
+        for n in lengths:
+            sequence = synthetic(h, n)
+            yield "hmm.viterbi.%s.checkpoint.n%d" % (basename, n), lambda h=h, s=sequence: h.viterbi(s)
+        h = HMM()
+        h.load(basename)
+        for n in lengths:
+            yield "hmm.generate.%s.n%d" % (basename, n), lambda h=h, n=n: synthetic(h, n)
+
+
+def bn_cases(lengths):
+    from alarm import alarm_compiled, alarm_infer
+    from carnet import car_compiled, car_infer
+
+    yield "bn.alarm.query", lambda: alarm_infer.query(variables=["JohnCalls"], evidence={"Earthquake": "yes"}, show_progress=False)
+    yield "bn.alarm.query.joint", lambda: alarm_infer.query(variables=["MaryCalls", "JohnCalls"], evidence={"Alarm": "yes"}, show_progress=False)
+    yield "bn.carnet.query", lambda: car_infer.query(variables=["Battery"], evidence={"Moves": "no"}, show_progress=False)
+    yield "bn.carnet.query.two_evidence", lambda: car_infer.query(variables=["Ignition"], evidence={"Moves": "no", "Gas": "Empty"}, show_progress=False)
+    # The same queries with the evidence values changing every call, answered from the compiled tables
+    alarm_evidence = itertools.cycle([{"Earthquake": "yes"}, {"Earthquake": "no"}])
+    car_evidence = itertools.cycle([{"Moves": moves, "Gas": gas} for moves in ("yes", "no") for gas in ("Full", "Empty")])
+    yield "bn.alarm.compiled.query", lambda: alarm_compiled.query(["JohnCalls"], next(alarm_evidence))
+    yield "bn.carnet.compiled.query.two_evidence", lambda: car_compiled.query(["Ignition"], next(car_evidence))
+    yield "bn.carnet.compiled.probabilities.two_evidence", lambda: car_compiled.probabilities(["Ignition"], next(car_evidence))
+    # Diagnosing many cars at once, against asking VariableElimination about each one
+    import numpy
+    rng = numpy.random.default_rng(0)
+    rows = [{"Moves": moves, "Radio": radio} for moves, radio in zip(rng.choice(["yes", "no"], 200), rng.choice(["turns on", "Doesn't turn on"], 200))]
+    yield "bn.carnet.batch.n200", lambda: car_compiled.probabilities_batch(["Battery", "Ignition"], rows)
+    yield "bn.carnet.loop.n200", lambda: [car_infer.query(["Battery", "Ignition"], evidence=row, show_progress=False) for row in rows]
+    # Sampling to within 0.01 standard error, with a fixed seed so the work is the same every run
+    from bn_sampling import SamplingInference
+    from carnet import car_model
+    car_sampler = SamplingInference(car_model)
+    yield "bn.carnet.likelihood_weighting", lambda: car_sampler.likelihood_weighting(["Battery"], {"Moves": "no"}, seed=0)
+    yield "bn.carnet.gibbs", lambda: car_sampler.gibbs(["Battery"], {"Moves": "no"}, seed=0)
+
+
+def sklearn_cases(lengths):
+    from sklearn.datasets import load_breast_cancer, load_digits
+    import sklearn_decisiontrees
+
+    X, y = load_digits(return_X_y=True)
+    # Without the experiment cache, so every run really fits
+    yield "sklearn.kfold.digits", lambda: sklearn_decisiontrees.kfold_scores(X, y, cache_dir=None)
+    X_cancer, y_cancer = load_breast_cancer(return_X_y=True, as_frame=True)
+    yield "sklearn.gridsearch.breast_cancer", lambda: sklearn_decisiontrees.grid_search(X_cancer, y_cancer, cache_dir=None)
+    # A rerun where every fold comes from the cache
+    cache_dir = tempfile.mkdtemp()
+    yield "sklearn.gridsearch.breast_cancer.cached", lambda: sklearn_decisiontrees.grid_search(X_cancer, y_cancer, cache_dir=cache_dir)
+
+
+def startup_cases(lengths):
+    # Fresh interpreters, so these include everything a one-off CLI run pays for
+    def python(*args):
+        return lambda: subprocess.run([sys.executable, *args], check=True, stdout=subprocess.DEVNULL, cwd=HERE)
+
+    yield "startup.python", python("-c", "pass")
+    yield "startup.import.numpy", python("-c", "import numpy")
+    yield "startup.import.HMM", python("-c", "import HMM")
+    yield "startup.cli.viterbi.partofspeech", python("HMM.py", "partofspeech", "--viterbi", "ambiguous_sents.obs")
+
+
+GROUPS = {"hmm": hmm_cases, "bn": bn_cases, "sklearn": sklearn_cases, "startup": startup_cases}
+# The sklearn fits take seconds each, so they're repeated less
+REPEATS = {"hmm": 5, "bn": 5, "sklearn": 2, "startup": 5}
+
+
+def run_benchmarks(groups, lengths, repeat_scale=1.0, names=None):
+    """times every case in groups (or only those in names), returns {name: timing} with each
+    min also given as a multiple of the calibration loop ("calibrated")"""
+    results = {}
+    references = []
+    for group in groups:
+        repeat = max(1, int(REPEATS[group] * repeat_scale))
+        for name, fn in GROUPS[group](lengths):
+            if names is not None and name not in names:
+                continue
+            # One untimed call so imports and lazy compilation aren't counted
+            fn()
+            references.append(timed(calibration, 3)["min"])
+            results[name] = timed(fn, repeat)
+            print("%-45s %10.6f s" % (name, results[name]["min"]), file=sys.stderr)
+    # One reference for the whole run: the median of the calibrations spread through it,
+    # since a single short calibration is as noisy as the cases it would divide
+    reference = statistics.median(references or [timed(calibration, 3)["min"]])
+    print("%-45s %10.6f s" % ("calibration (median)", reference), file=sys.stderr)
+    for result in results.values():
+        result["calibration"] = reference
+        result["calibrated"] = result["min"] / reference
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """returns (name, baseline, calibrated, ratio) for every case slower than
+    baseline * (1 + tolerance), comparing each case's min as a multiple of the
+    calibration loop's median time in the same run. Baselines saved before calibration was
+    added have no calibrated times and aren't compared."""
+    regressions = []
+    for name, result in results.items():
+        if "calibrated" not in baseline.get(name, {}):
+            continue
+        ratio = result["calibrated"] / baseline[name]["calibrated"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, baseline[name]["calibrated"], result["calibrated"], ratio))
+    return regressions
+
+
+def run_fresh(args, groups, names=None):
+    """runs the benchmarks again in a new interpreter and returns its results. How fast
+    some cases run varies from one process to the next (by up to 2x here) while staying
+    steady within it, so a second sample has to come from another process."""
+    with tempfile.TemporaryDirectory() as tmp:
+        output = Path(tmp) / "results.json"
+        command = [sys.executable, str(Path(__file__).resolve()), "--only", ",".join(groups),
+                   "--lengths", args.lengths, "--baseline", "", "--output", str(output)]
+        if args.quick:
+            command.append("--quick")
+        if names is not None:
+            command += ["--cases", ",".join(sorted(names))]
+        subprocess.run(command, check=True, cwd=HERE)
+        with output.open() as f:
+            return json.load(f)["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog = 'benchmark.py',
+                    description = 'Times the HMM, Bayesian network and decision tree workloads and compares them to a baseline')
+    parser.add_argument('--only', metavar = "GROUPS", default = ",".join(GROUPS), help = "Comma separated groups to run out of %s" % ", ".join(GROUPS))
+    parser.add_argument('--lengths', metavar = "N,N", default = "10,100,1000", help = "Synthetic observation sequence lengths for the HMM cases")
+    parser.add_argument('--quick', action = "store_true", help = "Shorter sequences and fewer repeats, for a smoke test")
+    parser.add_argument('--output', metavar = "file", help = "Writes the results as JSON to this file instead of stdout")
+    parser.add_argument('--baseline', metavar = "file", default = BASELINE, help = "The baseline JSON to compare against")
+    parser.add_argument('--save-baseline', action = "store_true", help = "Writes these results to the baseline file instead of comparing")
+    parser.add_argument('--cases', metavar = "NAMES", help = "Only runs these comma separated cases out of the groups")
+    parser.add_argument('--tolerance', type = float, default = 0.5, help = "How much slower than the baseline (as a fraction, relative to the calibration loop) counts as a regression")
+    args = parser.parse_args()
+
+    groups = [group for group in args.only.split(",") if group]
+    for group in groups:
+        if group not in GROUPS:
+            parser.error("unknown group %s" % group)
+    lengths = [10, 100] if args.quick else [int(n) for n in args.lengths.split(",")]
+    names = set(args.cases.split(",")) if args.cases else None
+    results = run_benchmarks(groups, lengths, 0.4 if args.quick else 1.0, names)
+    report = {"python": platform.python_version(), "platform": platform.platform(),
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+    if args.save_baseline:
+        # A baseline from a fast process would make every later run look slow, so each
+        # case keeps the slower of two runs
+        for name, result in run_fresh(args, groups, names).items():
+            if name in results and result["calibrated"] > results[name]["calibrated"]:
+                results[name] = result
+        # Keeps the cases that weren't run this time
+        baseline_path = Path(args.baseline)
+        if baseline_path.is_file():
+            with baseline_path.open() as f:
+                stored = json.load(f)
+            stored["results"].update(results)
+            results = stored["results"]
+        with baseline_path.open("w") as f:
+            json.dump(dict(report, results=results), f, indent=2, sort_keys=True)
+        sys.exit()
+
+    report["regressions"] = []
+    if Path(args.baseline).is_file():
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        # A case only counts as slower if it is again when timed in a new process
+        suspects = {name for name, _, _, _ in compare(results, baseline, args.tolerance)}
+        if suspects:
+            print("Timing %d slower cases again" % len(suspects), file=sys.stderr)
+            for name, result in run_fresh(args, groups, suspects).items():
+                if result["calibrated"] < results[name]["calibrated"]:
+                    results[name] = result
+        for name, before, after, ratio in compare({name: results[name] for name in suspects}, baseline, args.tolerance):
+            report["regressions"].append({"name": name, "baseline": before, "calibrated": after, "ratio": ratio})
+            print("REGRESSION %s: %.2fx -> %.2fx calibration (%.2fx)" % (name, before, after, ratio), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if report["regressions"]:
+        sys.exit(1)
@@ -0,0 +1,129 @@
+import numpy
+from pgmpy.factors.discrete import DiscreteFactor
+from pgmpy.inference import VariableElimination
+
+
+# Compiled inference - answers repeated queries on a BayesianNetwork without
+# re-running variable elimination. The first query with a given set of query
+# and evidence variables eliminates everything else once and keeps the joint
+# table P(query, evidence); every later query with that pattern (whatever the
+# evidence values) is just an index into that table and a normalization.
+#
+#     from alarm import alarm_model
+#     alarm_compiled = CompiledInference(alarm_model)
+#     alarm_compiled.query(["JohnCalls"], evidence={"Earthquake": "yes"})
+
+class CompiledInference:
+    """answers repeated queries from cached joint tables instead of eliminating again,
+    a drop-in for VariableElimination.query when the same patterns are asked many times"""
+    def __init__(self, model):
+        """wraps a BayesianNetwork with all of its CPDs added"""
+        self.model = model
+        self._engine = VariableElimination(model)
+        self.state_names = {cpd.variable: list(cpd.state_names[cpd.variable]) for cpd in model.get_cpds()}
+        self.cardinality = {variable: len(states) for variable, states in self.state_names.items()}
+        self.state_index = {variable: {state: idx for idx, state in enumerate(states)}
+                            for variable, states in self.state_names.items()}
+        # (variable, variable, ...) -> joint probability array with one axis per variable, in that order
+        self._joints = {}
+
+    def joint(self, variables):
+        """returns P(variables) as an array with one axis per variable in the given order,
+        eliminating the other variables the first time these are asked for"""
+        key = tuple(variables)
+        if key not in self._joints:
+            factor = self._engine.query(list(key), joint=True, show_progress=False)
+            values = factor.values.transpose([factor.variables.index(variable) for variable in key])
+            # Puts each axis in the CPD's state order in case the factor's differs
+            for axis, variable in enumerate(key):
+                order = [factor.state_names[variable].index(state) for state in self.state_names[variable]]
+                values = numpy.take(values, order, axis=axis)
+            self._joints[key] = numpy.ascontiguousarray(values)
+        return self._joints[key]
+
+    def compile(self, variables, evidence_variables=()):
+        """precomputes the table for queries of variables given evidence_variables"""
+        self.joint(self._pattern(variables, evidence_variables))
+
+    def _pattern(self, variables, evidence_variables):
+        variables = list(variables)
+        evidence_variables = sorted(evidence_variables)
+        for variable in variables + evidence_variables:
+            if variable not in self.state_names:
+                raise ValueError("%s is not a variable in the network" % variable)
+        if len(set(variables)) != len(variables) or set(variables) & set(evidence_variables):
+            raise ValueError("the query variables must be distinct and not in the evidence")
+        return variables + evidence_variables
+
+    def probabilities(self, variables, evidence=None):
+        """returns P(variables | evidence) as an array with one axis per query variable,
+        states in the CPD order. Raises ValueError if the evidence is impossible."""
+        evidence = evidence or {}
+        table = self.joint(self._pattern(variables, evidence))
+        if evidence:
+            try:
+                index = tuple(self.state_index[variable][evidence[variable]] for variable in sorted(evidence))
+            except KeyError as e:
+                raise ValueError("unknown state %s in the evidence" % e) from None
+            # The evidence axes are last, so this picks the slice for the observed states
+            table = table[(Ellipsis,) + index]
+        total = table.sum()
+        if total == 0:
+            raise ValueError("the evidence %s has probability zero" % evidence)
+        return table / total
+
+    def _evidence_codes(self, evidence):
+        """turns a DataFrame or list of evidence dicts into the evidence variable names and
+        an (n, variables) array of state numbers, -1 where a row doesn't observe a variable"""
+        if hasattr(evidence, "columns"):
+            columns = {column: numpy.asarray(evidence[column], dtype=object) for column in evidence.columns}
+        else:
+            evidence = list(evidence)
+            columns = {variable: numpy.array([row.get(variable) for row in evidence], dtype=object)
+                       for variable in {variable for row in evidence for variable in row}}
+        n = len(evidence)
+        names = sorted(columns)
+        codes = numpy.full((n, len(names)), -1, dtype=numpy.intp)
+        for col, variable in enumerate(names):
+            if variable not in self.state_names:
+                raise ValueError("%s is not a variable in the network" % variable)
+            values = columns[variable]
+            for idx, state in enumerate(self.state_names[variable]):
+                codes[values == state, col] = idx
+            # None and NaN mean unobserved, anything else must be a state
+            missing = numpy.equal(values, None) | (values != values)
+            unknown = (codes[:, col] == -1) & ~missing
+            if unknown.any():
+                raise ValueError("unknown state %s for %s in the evidence" % (values[unknown][0], variable))
+        return names, codes
+
+    def probabilities_batch(self, variables, evidence):
+        """returns P(variables | row) for every row of evidence at once, as an array of shape
+        (rows, one axis per query variable). evidence is a DataFrame with a column per
+        evidence variable or a list of evidence dicts; None/NaN leaves a variable unobserved
+        in that row. Rows with impossible evidence come back as NaN."""
+        names, codes = self._evidence_codes(evidence)
+        shape = tuple(self.cardinality[variable] for variable in variables)
+        result = numpy.empty((len(codes),) + shape)
+        # Rows observing the same variables share a table and are answered with one fancy index
+        patterns, inverse = numpy.unique(codes >= 0, axis=0, return_inverse=True)
+        for number, observed in enumerate(patterns):
+            rows = numpy.flatnonzero(inverse.reshape(-1) == number)
+            evidence_variables = [name for name, seen in zip(names, observed) if seen]
+            table = self.joint(self._pattern(variables, evidence_variables))
+            if evidence_variables:
+                index = tuple(codes[rows, col] for col in numpy.flatnonzero(observed))
+                # The evidence axes are last, so this gives (query axes..., rows)
+                tables = numpy.moveaxis(table[(Ellipsis,) + index], -1, 0)
+            else:
+                tables = numpy.broadcast_to(table, (len(rows),) + shape)
+            totals = tables.reshape(len(rows), -1).sum(axis=1)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                result[rows] = tables / totals.reshape((-1,) + (1,) * len(shape))
+        return result
+
+    def query(self, variables, evidence=None):
+        """the same as VariableElimination.query(variables, evidence), returns a DiscreteFactor"""
+        values = self.probabilities(variables, evidence)
+        return DiscreteFactor(list(variables), [self.cardinality[variable] for variable in variables], values,
+                              state_names={variable: self.state_names[variable] for variable in variables})
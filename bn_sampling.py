@@ -0,0 +1,293 @@
+import time
+
+import numpy
+from pgmpy.factors.discrete import DiscreteFactor
+
+from process_pools import process_pool
+
+
+# Sampling inference - approximate answers for BayesianNetworks too big for
+# variable elimination. Both samplers work on whole arrays of samples at once:
+#
+#   likelihood weighting - draws every non-evidence variable from its CPD in
+#       topological order, weighting each sample by how likely the evidence is
+#   gibbs - runs Markov chains that resample one variable at a time from its
+#       distribution given its Markov blanket, with R-hat/ESS diagnostics
+#
+# Both keep drawing until every estimated probability's standard error is under
+# tolerance, or time_limit seconds run out.
+#
+#     from carnet import car_model
+#     car_sampler = SamplingInference(car_model)
+#     car_sampler.query(["Battery"], evidence={"Moves": "no"}, tolerance=0.005)
+
+class Estimate:
+    def __init__(self, variables, probabilities, stderr, samples, ess, seconds, converged, rhat=None):
+        self.variables = variables          # the query variables
+        self.probabilities = probabilities  # estimated P(variables | evidence), one axis per variable
+        self.stderr = stderr                # standard error of each probability
+        self.samples = samples              # samples (or chain steps) drawn
+        self.ess = ess                      # effective sample size
+        self.seconds = seconds
+        self.converged = converged          # whether every stderr got under the tolerance
+        self.rhat = rhat                    # gibbs only, the worst split R-hat over the query states
+    def __repr__(self):
+        return "Estimate(%s, stderr=%.4f, samples=%d, ess=%.0f, rhat=%s, converged=%s)" % (
+            numpy.round(self.probabilities, 4).tolist(), self.stderr.max(), self.samples, self.ess,
+            None if self.rhat is None else round(self.rhat, 4), self.converged)
+
+
+def split_rhat(draws):
+    """the split R-hat of draws with shape (chains, steps), near 1 once the chains agree"""
+    half = draws.shape[1] // 2
+    chains = numpy.concatenate([draws[:, :half], draws[:, half:2 * half]])
+    n = chains.shape[1]
+    within = chains.var(axis=1, ddof=1).mean()
+    between = n * chains.mean(axis=1).var(ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else numpy.inf
+    return float(numpy.sqrt(((n - 1) / n * within + between / n) / within))
+
+
+def effective_sample_size(draws):
+    """the effective sample size of draws with shape (chains, steps), from the autocorrelation
+    averaged over chains and summed in pairs until it goes negative (Geyer's initial sequence)"""
+    chains, n = draws.shape
+    centered = draws - draws.mean(axis=1, keepdims=True)
+    # Autocovariance of every chain at once with an FFT
+    spectrum = numpy.fft.rfft(centered, 2 * n, axis=1)
+    autocov = numpy.fft.irfft(spectrum * spectrum.conj(), axis=1)[:, :n] / n
+    within = autocov[:, 0].mean() * n / (n - 1)
+    variance = within * (n - 1) / n + (draws.mean(axis=1).var(ddof=1) if chains > 1 else 0)
+    if variance == 0:
+        return float(chains * n)
+    rho = 1 - (within - autocov.mean(axis=0)) / variance
+    rho[0] = 1
+    total = 0.0
+    for t in range(0, n - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0:
+            break
+        total += pair
+    return float(min(chains * n / max(2 * total - 1, 1e-12), chains * n * numpy.log10(chains * n)))
+
+
+class SamplingInference:
+    def __init__(self, model):
+        """wraps a BayesianNetwork with all of its CPDs added"""
+        self.model = model
+        cpds = {cpd.variable: cpd for cpd in model.get_cpds()}
+        # Kahn's algorithm, so every variable comes after its parents
+        parents = {variable: list(cpds[variable].variables[1:]) for variable in cpds}
+        self.variables = []
+        remaining = dict(parents)
+        while remaining:
+            ready = sorted(variable for variable, needs in remaining.items() if not set(needs) - set(self.variables))
+            self.variables += ready
+            for variable in ready:
+                del remaining[variable]
+        self.index = {variable: idx for idx, variable in enumerate(self.variables)}
+        self.state_names = {variable: list(cpds[variable].state_names[variable]) for variable in self.variables}
+        self.cardinality = [len(self.state_names[variable]) for variable in self.variables]
+        self.state_index = {variable: {state: idx for idx, state in enumerate(states)}
+                            for variable, states in self.state_names.items()}
+        # parents[v] are variable numbers, cpts[v] has one axis per parent then one for v itself
+        self.parents = [[self.index[parent] for parent in parents[variable]] for variable in self.variables]
+        self.cpts = []
+        for variable in self.variables:
+            cpd = cpds[variable]
+            values = cpd.get_values().reshape([cpd.cardinality[0]] + list(cpd.cardinality[1:]))
+            self.cpts.append(numpy.moveaxis(values, 0, -1))
+        self.children = [[child for child in range(len(self.variables)) if v in self.parents[child]]
+                         for v in range(len(self.variables))]
+
+    def _codes(self, variables, evidence):
+        for variable in list(variables) + list(evidence):
+            if variable not in self.index:
+                raise ValueError("%s is not a variable in the network" % variable)
+        if set(variables) & set(evidence):
+            raise ValueError("the query variables must not be in the evidence")
+        try:
+            return {self.index[variable]: self.state_index[variable][state] for variable, state in evidence.items()}
+        except KeyError as e:
+            raise ValueError("unknown state %s in the evidence" % e) from None
+
+    def _conditional(self, v, samples):
+        # P(v | its parents) for every sample, shape (samples, states of v)
+        if not self.parents[v]:
+            return numpy.broadcast_to(self.cpts[v], (len(samples), self.cardinality[v]))
+        return self.cpts[v][tuple(samples[:, parent] for parent in self.parents[v])]
+
+    def forward_sample(self, n, evidence=None, rng=None):
+        """draws n samples with the evidence variables clamped, returns the (n, variables)
+        state numbers in self.variables order and each sample's likelihood weight"""
+        rng = numpy.random.default_rng(rng)
+        observed = self._codes([], evidence or {})
+        samples = numpy.zeros((n, len(self.variables)), dtype=numpy.intp)
+        weights = numpy.ones(n)
+        for v in range(len(self.variables)):
+            probs = self._conditional(v, samples)
+            if v in observed:
+                samples[:, v] = observed[v]
+                weights *= probs[:, observed[v]]
+            else:
+                samples[:, v] = _categorical(probs, rng)
+        return samples, weights
+
+    def _query_codes(self, variables, samples):
+        # One number per sample for the joint state of the query variables
+        return numpy.ravel_multi_index(tuple(samples[:, self.index[variable]] for variable in variables),
+                                       self._shape(variables))
+
+    def _shape(self, variables):
+        return tuple(self.cardinality[self.index[variable]] for variable in variables)
+
+    def likelihood_weighting(self, variables, evidence=None, tolerance=0.01, time_limit=None, batch_size=10000,
+                             max_samples=10 ** 7, jobs=1, seed=None):
+        """estimates P(variables | evidence) by likelihood weighting, drawing batch_size samples
+        (per process with jobs) at a time until the standard errors are under tolerance"""
+        evidence = evidence or {}
+        self._codes(variables, evidence)
+        size = int(numpy.prod(self._shape(variables)))
+        seeds = numpy.random.SeedSequence(seed)
+        start = time.perf_counter()
+        totals = numpy.zeros(size)
+        weight = weight_squared = 0.0
+        samples = 0
+        pool = _pool(jobs)
+        try :
+            while True :
+                batch = [(self, variables, evidence, batch_size, child) for child in seeds.spawn(max(jobs, 1))]
+                for counts, w, w2 in (pool.map(_weighted_counts, batch) if pool else map(_weighted_counts, batch)) :
+                    totals += counts
+                    weight += w
+                    weight_squared += w2
+                samples += batch_size * len(batch)
+                ess = weight ** 2 / weight_squared if weight_squared else 0.0
+                probabilities = totals / weight if weight else numpy.full(size, numpy.nan)
+                stderr = numpy.sqrt(probabilities * (1 - probabilities) / ess) if ess else numpy.full(size, numpy.inf)
+                converged = bool(numpy.all(stderr <= tolerance))
+                if converged or samples >= max_samples or time_limit is not None and time.perf_counter() - start >= time_limit :
+                    break
+        finally :
+            if pool :
+                pool.close()
+        shape = self._shape(variables)
+        return Estimate(list(variables), probabilities.reshape(shape), stderr.reshape(shape), samples, ess,
+                        time.perf_counter() - start, converged)
+
+    def gibbs_sweeps(self, samples, observed, sweeps, rng):
+        """runs sweeps of gibbs sampling on the (chains, variables) states in samples, in place,
+        and returns the states after every sweep, shape (sweeps, chains, variables)"""
+        hidden = [v for v in range(len(self.variables)) if v not in observed]
+        history = numpy.empty((sweeps,) + samples.shape, dtype=numpy.intp)
+        for sweep in range(sweeps):
+            for v in hidden:
+                # P(v | markov blanket) is P(v | parents) * P(each child | its parents), for every state of v
+                probs = self._conditional(v, samples).copy()
+                for child in self.children[v]:
+                    index = tuple(numpy.arange(self.cardinality[v])[None, :] if parent == v else samples[:, parent][:, None]
+                                  for parent in self.parents[child])
+                    probs *= self.cpts[child][index + (samples[:, child][:, None],)]
+                samples[:, v] = _categorical(probs / probs.sum(axis=1, keepdims=True), rng)
+            history[sweep] = samples
+        return history
+
+    def gibbs(self, variables, evidence=None, tolerance=0.01, time_limit=None, chains=32, sweeps=500, burn_in=100,
+              max_sweeps=100000, jobs=1, seed=None):
+        """estimates P(variables | evidence) with chains gibbs chains (spread over jobs processes),
+        each started from a likelihood-weighted sample. After burn_in sweeps it runs sweeps more,
+        then doubles the draws each round until the standard errors (from the effective sample
+        size) are under tolerance and split R-hat is under 1.01."""
+        evidence = evidence or {}
+        observed = self._codes(variables, evidence)
+        shape = self._shape(variables)
+        size = int(numpy.prod(shape))
+        start = time.perf_counter()
+        seeds = numpy.random.SeedSequence(seed)
+        jobs = max(1, min(jobs, chains))
+        groups = numpy.array_split(numpy.arange(chains), jobs)
+        rngs = [numpy.random.default_rng(child) for child in seeds.spawn(jobs)]
+        states = []
+        for group, rng in zip(groups, rngs):
+            samples, weights = self.forward_sample(len(group) * 100, evidence, rng)
+            states.append(samples[rng.choice(len(samples), len(group), p=weights / weights.sum())])
+        pool = _pool(jobs)
+        def run(count) :
+            nonlocal states, rngs
+            work = [(self, state, observed, count, rng, variables) for state, rng in zip(states, rngs)]
+            results = pool.map(_gibbs_chunk, work) if pool else list(map(_gibbs_chunk, work))
+            states = [state for state, _, _ in results]
+            rngs = [rng for _, _, rng in results]
+            return numpy.concatenate([codes for _, codes, _ in results])
+        try :
+            # The burn in draws are thrown away
+            if burn_in :
+                run(burn_in)
+            draws = numpy.empty((chains, 0), dtype=numpy.intp)
+            count = sweeps
+            while True :
+                started = time.perf_counter()
+                draws = numpy.concatenate([draws, run(count)], axis=1)
+                per_sweep = (time.perf_counter() - started) / count
+                indicators = [(draws == code).astype(float) for code in range(size)]
+                probabilities = numpy.array([indicator.mean() for indicator in indicators])
+                ess = numpy.array([effective_sample_size(indicator) for indicator in indicators])
+                rhat = max(split_rhat(indicator) for indicator in indicators)
+                stderr = numpy.sqrt(probabilities * (1 - probabilities) / ess)
+                converged = bool(numpy.all(stderr <= tolerance) and rhat < 1.01)
+                if converged or draws.shape[1] >= max_sweeps or time_limit is not None and time.perf_counter() - start >= time_limit :
+                    break
+                # Each round doubles the draws, so the diagnostics are only recomputed a few times,
+                # but never runs past the time limit
+                count = min(draws.shape[1], max_sweeps - draws.shape[1])
+                if time_limit is not None :
+                    count = max(1, min(count, int((time_limit - (time.perf_counter() - start)) / per_sweep)))
+        finally :
+            if pool :
+                pool.close()
+        steps = (burn_in + draws.shape[1]) * chains
+        return Estimate(list(variables), probabilities.reshape(shape), stderr.reshape(shape), steps, float(ess.min()),
+                        time.perf_counter() - start, converged, rhat)
+
+    def query(self, variables, evidence=None, method="likelihood_weighting", **options):
+        """like VariableElimination.query, returns the estimate as a DiscreteFactor. method is
+        likelihood_weighting or gibbs, options are passed on to it."""
+        match method :
+            case "likelihood_weighting" :
+                estimate = self.likelihood_weighting(variables, evidence, **options)
+            case "gibbs" :
+                estimate = self.gibbs(variables, evidence, **options)
+            case _ :
+                raise ValueError("unknown method %s" % method)
+        return DiscreteFactor(list(variables), list(self._shape(variables)), estimate.probabilities,
+                              state_names={variable: self.state_names[variable] for variable in variables})
+
+
+def _categorical(probs, rng):
+    # One draw per row of probs
+    cdf = probs.cumsum(axis=1)
+    draws = (rng.random(len(probs))[:, None] * cdf[:, -1:] > cdf).sum(axis=1)
+    return numpy.minimum(draws, probs.shape[1] - 1)
+
+
+def _pool(jobs):
+    # Processes only when asked for, forked so the workers start quickly
+    if jobs <= 1 :
+        return None
+    return process_pool(jobs)
+
+
+def _weighted_counts(args):
+    sampler, variables, evidence, n, seed = args
+    samples, weights = sampler.forward_sample(n, evidence, numpy.random.default_rng(seed))
+    counts = numpy.bincount(sampler._query_codes(variables, samples), weights, int(numpy.prod(sampler._shape(variables))))
+    return counts, weights.sum(), (weights ** 2).sum()
+
+
+def _gibbs_chunk(args):
+    # Runs some of the chains for count sweeps, returning their states, the query draws and the rng to carry on with
+    sampler, state, observed, count, rng, variables = args
+    history = sampler.gibbs_sweeps(state, observed, count, rng)
+    codes = sampler._query_codes(variables, history.reshape(-1, history.shape[2])).reshape(count, -1).T
+    return state, codes, rng
@@ -1,6 +1,8 @@
 from pgmpy.models import BayesianNetwork
 from pgmpy.inference import VariableElimination
 
+from bn_inference import CompiledInference
+
 car_model = BayesianNetwork(
     [
         ("Battery", "Radio"),
@@ -71,6 +73,7 @@ cpd_moves = TabularCPD(
 car_model.add_cpds( cpd_starts, cpd_ignition, cpd_gas, cpd_key, cpd_radio, cpd_battery, cpd_moves)
 
 car_infer = VariableElimination(car_model)
+car_compiled = CompiledInference(car_model)
 
 if __name__ == '__main__' :
     print(car_infer.query(variables=["Moves"], evidence={"Radio": "turns on", "Starts": "yes"}))
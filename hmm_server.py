@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import math
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from HMM import HMM, positive_int
+from process_pools import pool_context
+
+
+# hmm_server - loads an HMM once and answers forward/viterbi/generate requests
+# over HTTP (or a unix socket), so each request skips interpreter startup and
+# parsing the .trans/.emit files.
+#
+#     python hmm_server.py partofspeech --port 8765 &
+#     curl -d '{"sentence": "i shot the elephant ."}' localhost:8765/viterbi
+#
+# POST /forward   {"sentence": "..."} or {"tokens": [...]}
+#                 -> {"state": "NOUN", "loglikelihood": -30.1}
+# POST /viterbi   {"sentence": "...", "nbest": 3, "confidence": true}
+#                 -> {"states": [...], "logprob": ..., "loglikelihood": ..., "nbest": [...], "confidences": [...]}
+# POST /generate  {"n": 20, "seed": 1} -> {"observations": [...], "states": [...]}
+# GET  /stats     -> request, batch and cache counters
+
+REASONS = {200: b"OK", 400: b"Bad Request", 404: b"Not Found", 405: b"Method Not Allowed"}
+METHODS = ("forward", "viterbi", "generate")
+# The most a single request may ask for, so one request can't tie up the workers
+MAX_GENERATE = 100000
+MAX_NBEST = 100
+
+
+class LRUCache:
+    """a dict that keeps only the size most recently used entries"""
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def _number(x):
+    # JSON has no infinity, impossible sequences get null
+    return x if math.isfinite(x) else None
+
+
+def _is_int(x):
+    # JSON true/false come back as bools, which are ints to isinstance
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def _job(method, body):
+    """checks a request body and returns the hashable job for it, raises ValueError if it's bad"""
+    if not isinstance(body, dict):
+        raise ValueError("the request body must be a JSON object")
+    if method == "generate":
+        n = body.get("n", 20)
+        if not _is_int(n) or not 0 <= n <= MAX_GENERATE:
+            raise ValueError("n must be an integer from 0 to %d" % MAX_GENERATE)
+        # The seed is part of the cache key, so it has to be hashable as well as valid
+        seed = body.get("seed")
+        if seed is not None and (not _is_int(seed) or seed < 0):
+            raise ValueError("seed must be a non-negative integer")
+        return ("generate", n, seed)
+    if "tokens" in body:
+        tokens = body["tokens"]
+        if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+            raise ValueError("tokens must be a list of strings")
+    elif isinstance(body.get("sentence"), str):
+        tokens = body["sentence"].split()
+    else:
+        raise ValueError("give the observations as sentence or tokens")
+    if method == "forward":
+        return ("forward", tuple(tokens))
+    nbest = body.get("nbest")
+    if nbest is not None and (not _is_int(nbest) or not 1 <= nbest <= MAX_NBEST):
+        raise ValueError("nbest must be an integer from 1 to %d" % MAX_NBEST)
+    return ("viterbi", tuple(tokens), nbest, bool(body.get("confidence")))
+
+
+def answer(model, job):
+    """runs one job on model and returns the JSON response for it"""
+    match job :
+        case ("forward", tokens) :
+            return {"state": model.forward(tokens), "loglikelihood": _number(model.log_likelihood(tokens))}
+        case ("viterbi", tokens, nbest, confidence) :
+            decoded = model.decode(tokens)
+            result = {"states": decoded.stateseq, "logprob": _number(decoded.logprob),
+                      "loglikelihood": _number(decoded.loglikelihood)}
+            if nbest :
+                result["nbest"] = [{"states": sequence.stateseq, "logprob": sequence.logprob}
+                                   for sequence in model.nbest(tokens, nbest)]
+            if confidence :
+                result["confidences"] = model.confidences(tokens, decoded.stateseq) if decoded.loglikelihood > -math.inf else None
+            return result
+        case ("generate", n, seed) :
+            generated = model.generate(n, seed, states=True)
+            return {"observations": generated.outputseq, "states": generated.stateseq}
+
+
+def answer_batch(model, jobs):
+    """answers a batch of jobs, identical jobs in the batch are only run once"""
+    answers = {}
+    results = []
+    for job in jobs :
+        if job not in answers or job[0] == "generate" and job[2] is None :
+            try :
+                answers[job] = (200, answer(model, job))
+            except Exception as e :
+                answers[job] = (400, {"error": str(e)})
+        results.append(answers[job])
+    return results
+
+
+# Process pool workers hold their own copy of the model
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _answer_worker(jobs):
+    return answer_batch(_worker_model, jobs)
+
+
+class HMMServer:
+    """serves one loaded model. Requests that arrive within batch_wait seconds of each
+    other (up to batch_size of them) are decoded together in a worker thread, or split
+    across jobs processes, while the event loop keeps accepting connections. Answers
+    are kept in an LRU cache of cache_size entries so repeated sentences are free."""
+    def __init__(self, model, cache_size=1024, batch_size=64, batch_wait=0.002, jobs=1):
+        self.model = model
+        self.cache = LRUCache(cache_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.jobs = jobs
+        self.requests = 0
+        self.batches = 0
+        self.server = None
+        self._queue = None
+        self._batcher = None
+        self._loop = None
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """starts listening on host:port, or on the unix socket path if it's given"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        if self.jobs > 1 :
+            self._executor = ProcessPoolExecutor(self.jobs, pool_context(), _init_worker, (self.model,))
+        else :
+            # One thread, so the model is never used by two batches at once
+            self._executor = ThreadPoolExecutor(1)
+        self._batcher = asyncio.create_task(self._run_batches())
+        if path :
+            self.server = await asyncio.start_unix_server(self._handle, path)
+        else :
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self._batcher.cancel()
+        self._executor.shutdown()
+
+    def run_in_thread(self, host="127.0.0.1", port=0):
+        """serves from a background thread and returns the port, port 0 picks a free one.
+        stop() shuts it down."""
+        started = threading.Event()
+        async def main() :
+            await self.start(host, port)
+            self._stopped = asyncio.Event()
+            started.set()
+            await self._stopped.wait()
+            await self.close()
+        self._thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self._thread.join()
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches, "cache_entries": len(self.cache.entries),
+                "cache_hits": self.cache.hits, "cache_misses": self.cache.misses}
+
+    async def submit(self, job):
+        """queues a job for the next batch and waits for its (status, response)"""
+        future = self._loop.create_future()
+        await self._queue.put((job, future))
+        return await future
+
+    async def _run_batches(self):
+        while True :
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.batch_wait
+            while len(batch) < self.batch_size :
+                timeout = deadline - self._loop.time()
+                if timeout <= 0 :
+                    break
+                try :
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError :
+                    break
+            self.batches += 1
+            jobs = [job for job, _ in batch]
+            try :
+                if self.jobs > 1 :
+                    size = -(-len(jobs) // self.jobs)
+                    chunks = await asyncio.gather(*(self._loop.run_in_executor(self._executor, _answer_worker, jobs[i:i + size])
+                                                    for i in range(0, len(jobs), size)))
+                    results = [result for chunk in chunks for result in chunk]
+                else :
+                    results = await self._loop.run_in_executor(self._executor, answer_batch, self.model, jobs)
+            except Exception as e :
+                results = [(400, {"error": str(e)})] * len(jobs)
+            for (job, future), result in zip(batch, results) :
+                if not future.done() :
+                    future.set_result(result)
+
+    async def respond(self, method, path, body):
+        """returns (status, response) for one HTTP request"""
+        name = path.strip("/")
+        if name == "stats" :
+            return 200, self.stats()
+        if name not in METHODS :
+            return 404, {"error": "unknown path %s, use one of /%s or /stats" % (path, ", /".join(METHODS))}
+        if method != "POST" :
+            return 405, {"error": "use POST for /%s" % name}
+        self.requests += 1
+        try :
+            job = _job(name, json.loads(body or b"{}"))
+        except ValueError as e :
+            return 400, {"error": str(e)}
+        # Unseeded generate requests should differ every time, so they're never cached
+        cacheable = not (name == "generate" and job[2] is None)
+        if cacheable :
+            cached = self.cache.get(job)
+            if cached is not None :
+                return cached
+        result = await self.submit(job)
+        if cacheable and result[0] == 200 :
+            self.cache.put(job, result)
+        return result
+
+    async def _handle(self, reader, writer):
+        # A minimal HTTP/1.1 server, enough for curl, urllib and keep-alive clients
+        try :
+            while True :
+                request_line = await reader.readline()
+                if not request_line :
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True :
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b"") :
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.respond(method, urlsplit(target).path, body)
+                data = json.dumps(response).encode()
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                             % (status, REASONS[status], len(data)) + data)
+                await writer.drain()
+                if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close" :
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) :
+            pass
+        finally :
+            writer.close()
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(
+                    prog = 'hmm_server.py',
+                    description = 'Loads a Hidden Markov Model once and serves forward/viterbi/generate requests over HTTP')
+    parser.add_argument('basename', help = "The basename of the .emit and .trans file to serve")
+    parser.add_argument('--host', default = "127.0.0.1", help = "The address to listen on")
+    parser.add_argument('--port', type = int, default = 8765, help = "The port to listen on")
+    parser.add_argument('--unix', metavar = "path", help = "Listens on this unix socket instead of a TCP port")
+    parser.add_argument('--engine', choices = ["dense", "sparse"], default = "dense", help = "Decodes over compiled NumPy arrays (dense) or predecessor lists for large sparse models (sparse)")
+    parser.add_argument('--beam', metavar = "K", type = positive_int, help = "Keeps only the K most probable states per observation in Viterbi (approximate)")
+    parser.add_argument('--oov', choices = ["zero", "uniform", "suffix"], default = "zero", help = "How words missing from the .emit file are handled")
+    parser.add_argument('--cache-size', metavar = "N", type = int, default = 1024, help = "How many answers to keep for repeated requests, 0 turns the cache off")
+    parser.add_argument('--batch-size', metavar = "N", type = int, default = 64, help = "The most requests decoded together")
+    parser.add_argument('--batch-wait', metavar = "SECONDS", type = float, default = 0.002, help = "How long to wait for more requests to fill a batch")
+    parser.add_argument('--jobs', metavar = "N", type = int, default = 1, help = "Decodes each batch across N processes")
+    args = parser.parse_args()
+
+    h = HMM(engine = args.engine, logspace = True, beam = args.beam, oov = args.oov)
+    h.load(args.basename)
+    server = HMMServer(h, args.cache_size, args.batch_size, args.batch_wait, args.jobs)
+
+    async def main() :
+        await server.start(args.host, args.port, args.unix)
+        print("Serving %s on %s" % (args.basename, args.unix or "http://%s:%d" % (args.host, args.port)), file=sys.stderr)
+        await server.server.serve_forever()
+
+    try :
+        asyncio.run(main())
+    except KeyboardInterrupt :
+        pass
@@ -0,0 +1,17 @@
+# Process pools shared by the HMM batch decoding and Baum-Welch, the HMM server and
+# the Bayesian network samplers. multiprocessing is only imported when a pool is
+# actually started, so importing this costs nothing for single process runs.
+
+def pool_context():
+    """returns the fork multiprocessing context where the platform has it, which shares
+    the parent's loaded arrays with the workers instead of pickling them to each one and
+    starts them quickly, and the platform default elsewhere (e.g. Windows)"""
+    import multiprocessing
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def process_pool(jobs, initializer=None, initargs=()):
+    """returns a multiprocessing Pool of jobs worker processes from pool_context()"""
+    return pool_context().Pool(jobs, initializer=initializer, initargs=initargs)
@@ -1,38 +1,146 @@
+import argparse
+import json
+import os
+import pickle
+import time
+import tracemalloc
+from pathlib import Path
+
 from sklearn.datasets import load_iris, load_digits
 from sklearn import tree
+from sklearn.base import clone
 from sklearn.model_selection import KFold
 from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+import numpy as np
 import pandas as pd
-from sklearn.model_selection import GridSearchCV, KFold
+from sklearn.model_selection import KFold, ParameterGrid
 import joblib
 
 
+### Experiment runner - cross validates every parameter setting of an estimator with
+### the (setting, fold) fits spread across cores by joblib. Each fit's scores and
+### timings are stored in cache_dir under a hash of the data, the estimator's
+### parameters and the fold, so a rerun only fits what changed. Estimators without
+### a fixed random_state fit differently every time, so they're never cached.
+
+CACHE_DIR = Path(".experiment_cache")
+# Parameters that don't change what gets fit, so they're left out of the cache key
+UNHASHED_PARAMS = ("n_jobs", "verbose")
+
+def _rows(data, index) :
+    return data.iloc[index] if hasattr(data, "iloc") else data[index]
+
+def _cache_key(estimator, data_hash, train_index, test_index) :
+    params = {name: value for name, value in estimator.get_params().items() if name not in UNHASHED_PARAMS}
+    return joblib.hash((type(estimator).__name__, params, data_hash, train_index, test_index))
+
+def _reproducible(estimator) :
+    # Every random_state, including those of nested estimators, must be a fixed seed
+    return all(isinstance(value, (int, np.integer)) for name, value in estimator.get_params().items()
+               if name == "random_state" or name.endswith("__random_state"))
+
+def _fit_fold(estimator, X, y, train_index, test_index, return_train_score, return_estimator) :
+    """fits estimator on one fold, returns its scores and timings and the fitted estimator
+    (None unless return_estimator, so it isn't pickled back from the worker for nothing)"""
+    start = time.perf_counter()
+    estimator.fit(_rows(X, train_index), _rows(y, train_index))
+    fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    test_score = estimator.score(_rows(X, test_index), _rows(y, test_index))
+    score_time = time.perf_counter() - start
+    train_score = estimator.score(_rows(X, train_index), _rows(y, train_index)) if return_train_score else None
+    scores = {"test_score": test_score, "train_score": train_score, "fit_time": fit_time, "score_time": score_time}
+    return scores, estimator if return_estimator else None
+
+def _save_fold(cache_dir, key, scores, estimator=None) :
+    # Only the .json scores are read back; a fitted .model (with save_models) is kept so
+    # a fold can be inspected later with joblib.load, it's never used in place of fitting.
+    # Written to a temporary name and renamed so an interrupted run never leaves half a file
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if estimator is not None :
+        joblib.dump(estimator, cache_dir / (key + ".model.tmp"))
+        os.replace(cache_dir / (key + ".model.tmp"), cache_dir / (key + ".model"))
+    (cache_dir / (key + ".json.tmp")).write_text(json.dumps(scores))
+    os.replace(cache_dir / (key + ".json.tmp"), cache_dir / (key + ".json"))
+
+def cross_validate_cached(estimator, param_grid, X, y, cv, n_jobs=-1, cache_dir=CACHE_DIR, return_train_score=True, save_models=False) :
+    """cross validates estimator with every setting in param_grid over the folds of cv, like
+    GridSearchCV(...).cv_results_ as a DataFrame, plus a cached_folds column counting the
+    folds read from cache_dir instead of fit. cache_dir=None turns the cache off, as does
+    an estimator without a fixed random_state. save_models also writes each newly fitted
+    fold's estimator to the cache as a .model file, for inspection."""
+    cache_dir = Path(cache_dir) if cache_dir and _reproducible(estimator) else None
+    data_hash = joblib.hash((X, y))
+    folds = list(cv.split(X, y))
+    candidates = list(ParameterGrid(param_grid))
+    tasks = []
+    for params in candidates :
+        for train_index, test_index in folds :
+            fold_estimator = clone(estimator).set_params(**params)
+            # The folds are already parallel, so the estimator itself shouldn't be too
+            if n_jobs != 1 and "n_jobs" in fold_estimator.get_params() :
+                fold_estimator.set_params(n_jobs=1)
+            tasks.append((_cache_key(fold_estimator, data_hash, train_index, test_index), fold_estimator, train_index, test_index))
+
+    scores = {}
+    cached = set()
+    for key, _, _, _ in tasks :
+        if cache_dir and (cache_dir / (key + ".json")).is_file() :
+            scores[key] = json.loads((cache_dir / (key + ".json")).read_text())
+            cached.add(key)
+    todo = [task for task in tasks if task[0] not in scores]
+    fitted = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_fit_fold)(fold_estimator, X, y, train_index, test_index, return_train_score, save_models and cache_dir is not None)
+        for _, fold_estimator, train_index, test_index in todo)
+    for (key, _, _, _), (fold_scores, fitted_estimator) in zip(todo, fitted) :
+        scores[key] = fold_scores
+        if cache_dir :
+            _save_fold(cache_dir, key, fold_scores, fitted_estimator)
+
+    rows = []
+    for number, params in enumerate(candidates) :
+        keys = [task[0] for task in tasks[number * len(folds):(number + 1) * len(folds)]]
+        row = {"params": params}
+        row.update({"param_" + name: value for name, value in params.items()})
+        measures = ("test_score", "train_score", "fit_time", "score_time") if return_train_score else ("test_score", "fit_time", "score_time")
+        for measure in measures :
+            values = np.array([scores[key][measure] for key in keys])
+            if measure == "test_score" :
+                row.update({"split%d_test_score" % fold: value for fold, value in enumerate(values)})
+            row["mean_" + measure] = values.mean()
+            row["std_" + measure] = values.std()
+        row["cached_folds"] = sum(key in cached for key in keys)
+        rows.append(row)
+    results = pd.DataFrame(rows)
+    results["rank_test_score"] = results["mean_test_score"].rank(ascending=False, method="min").astype(int)
+    return results
+
+def timing_report(results) :
+    """one row per model and parameter setting with its score, mean fit/score times and cached folds"""
+    report = []
+    for result in results :
+        cv_results = result["cv_results"]
+        for _, row in cv_results.iterrows() :
+            report.append({"model": result["model"], "params": row["params"], "mean_test_score": row["mean_test_score"],
+                           "mean_fit_time": row["mean_fit_time"], "mean_score_time": row["mean_score_time"],
+                           "cached_folds": row["cached_folds"]})
+    return pd.DataFrame(report)
+
 ### This code shows how to use KFold to do cross_validation.
 ### This is just one of many ways to manage training and test sets in sklearn.
 
-# Used the digits dataset as the more complex dataset where each datapoint is a 8x8 image of a digit
-# Classes: 10 Samples total: 1797 Dimensionality: 64
-iris = load_digits()
-X, y = iris.data, iris.target
-scores = []
-kf = KFold(n_splits=5)
-for train_index, test_index in kf.split(X) :
-    X_train, X_test, y_train, y_test = \
-        (X[train_index], X[test_index], y[train_index], y[test_index])
-    clf = RandomForestClassifier(n_estimators=50, criterion='entropy')
-    clf.fit(X_train, y_train)
-    scores.append(clf.score(X_test, y_test))
-
-print(scores)
+def kfold_scores(X, y, n_splits=5, n_estimators=50, criterion='entropy', n_jobs=-1, cache_dir=CACHE_DIR) :
+    """fits and scores a Random Forest on each of n_splits folds, returns the fold scores.
+    The folds are fit in parallel and cached like cross_validate_cached."""
+    clf = RandomForestClassifier(n_estimators=n_estimators, criterion=criterion, random_state=0)
+    results = cross_validate_cached(clf, {}, X, y, KFold(n_splits=n_splits), n_jobs, cache_dir, return_train_score=False)
+    return [float(results["split%d_test_score" % fold][0]) for fold in range(n_splits)]
 
 ## Part 2. This code (from https://scikit-learn.org/1.5/auto_examples/ensemble/plot_forest_hist_grad_boosting_comparison.html)
 ## shows how to use GridSearchCV to do a hyperparameter search to compare two techniques.
 from sklearn.datasets import load_breast_cancer
 
-X,y = load_breast_cancer(return_X_y=True, as_frame=True)
-
 N_CORES = joblib.cpu_count(only_physical_cores=True)
-print(f"Number of physical cores: {N_CORES}")
 
 models = {
     "Random Forest": RandomForestClassifier(
@@ -48,91 +156,205 @@ param_grids = {
 }
 cv = KFold(n_splits=5, shuffle=True, random_state=0)
 
-results = []
-for name, model in models.items():
-    grid_search = GridSearchCV(
-        estimator=model,
-        param_grid=param_grids[name],
-        return_train_score=True,
-        cv=cv,
-    ).fit(X, y)
-    result = {"model": name, "cv_results": pd.DataFrame(grid_search.cv_results_)}
-    results.append(result)
+def grid_search(X, y, n_jobs=-1, cache_dir=CACHE_DIR, save_models=False) :
+    """cross validates every setting in param_grids for each model, like GridSearchCV with
+    the fits in parallel and cached, returns the cv_results of each"""
+    results = []
+    for name, model in models.items():
+        cv_results = cross_validate_cached(model, param_grids[name], X, y, cv, n_jobs, cache_dir, save_models=save_models)
+        result = {"model": name, "cv_results": cv_results}
+        results.append(result)
+    return results
+
+### Serving costs - for deploying these models for online scoring, measures how long
+### one row and whole batches take to predict, how much memory a loaded model takes
+### and how big it is pickled, next to its accuracy.
+
+def serving_costs(model, X_test, y_test, batch_sizes=(1, 100, 1000), single_rows=200, repeat=5) :
+    """returns the accuracy and serving costs of a fitted model: median/p95 single-row
+    latency, the best time for each batch size, rows per second at the largest batch,
+    the memory allocated loading it and its pickled size. Rows are passed the way the
+    model was fit, as a DataFrame if it has feature names and as an array otherwise."""
+    if hasattr(model, "feature_names_in_") :
+        X_test = pd.DataFrame(np.asarray(X_test), columns=model.feature_names_in_)
+    else :
+        X_test = np.asarray(X_test)
+    costs = {"accuracy": model.score(X_test, y_test)}
+    # Each single row is predicted separately, like an online request
+    latencies = []
+    for row in range(min(single_rows, len(X_test))) :
+        one = _rows(X_test, slice(row, row + 1))
+        start = time.perf_counter()
+        model.predict(one)
+        latencies.append(time.perf_counter() - start)
+    costs["single_median_ms"] = np.median(latencies) * 1000
+    costs["single_p95_ms"] = np.percentile(latencies, 95) * 1000
+    for size in batch_sizes :
+        # The test rows repeated until there are size of them
+        batch = _rows(X_test, np.resize(np.arange(len(X_test)), size))
+        times = []
+        for _ in range(repeat) :
+            start = time.perf_counter()
+            model.predict(batch)
+            times.append(time.perf_counter() - start)
+        costs["batch%d_ms" % size] = min(times) * 1000
+    costs["rows_per_s"] = max(batch_sizes) / (costs["batch%d_ms" % max(batch_sizes)] / 1000)
+    blob = pickle.dumps(model)
+    costs["serialized_kb"] = len(blob) / 1024
+    # What loading the model allocates is roughly what it holds in memory while serving
+    tracemalloc.start()
+    pickle.loads(blob)
+    costs["memory_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return costs
 
-print(results)
+def pareto_front(frame, cost, score="accuracy") :
+    """marks the rows no other row beats, i.e. none has at least their score at no more cost
+    and is better on one of them"""
+    scores, costs = frame[score].to_numpy(), frame[cost].to_numpy()
+    dominated = [np.any((scores >= scores[row]) & (costs <= costs[row]) & ((scores > scores[row]) | (costs < costs[row])))
+                 for row in range(len(frame))]
+    return ~np.array(dominated, dtype=bool)
+
+PARETO_COSTS = ("single_median_ms", "batch1000_ms", "memory_kb", "serialized_kb")
+
+def serving_benchmark(X, y, test_size=0.25, batch_sizes=(1, 100, 1000), **options) :
+    """fits every setting in param_grids for each model on a train split and measures its
+    serving_costs on the test split. Returns one row per setting with a pareto_<cost> column
+    for each of PARETO_COSTS that is measured, marking the settings worth deploying.
+    The models are fit on plain arrays, which skips the feature name checks a DataFrame
+    costs on every predict, and with n_jobs=1 (the Random Forest otherwise uses N_CORES)
+    so single-row latency doesn't include dispatching joblib threads."""
+    from sklearn.model_selection import train_test_split
+    X_train, X_test, y_train, y_test = train_test_split(np.asarray(X), np.asarray(y), test_size=test_size, random_state=0)
+    rows = []
+    for name, model in models.items() :
+        for params in ParameterGrid(param_grids[name]) :
+            estimator = clone(model).set_params(**params)
+            if "n_jobs" in estimator.get_params() :
+                estimator.set_params(n_jobs=1)
+            fitted = estimator.fit(X_train, y_train)
+            row = {"model": name, "params": params}
+            row.update(serving_costs(fitted, X_test, y_test, batch_sizes, **options))
+            rows.append(row)
+    report = pd.DataFrame(rows)
+    for cost in PARETO_COSTS :
+        if cost in report :
+            report["pareto_" + cost] = pareto_front(report, cost)
+    return report
 
 #### Part 3: This shows how to generate a scatter plot of your results
 
-import plotly.colors as colors
-import plotly.express as px
-from plotly.subplots import make_subplots
-
-fig = make_subplots(
-    rows=1,
-    cols=2,
-    shared_yaxes=True,
-    subplot_titles=["Train time vs score", "Predict time vs score"],
-)
-model_names = [result["model"] for result in results]
-colors_list = colors.qualitative.Plotly * (
-    len(model_names) // len(colors.qualitative.Plotly) + 1
-)
-
-for idx, result in enumerate(results):
-    cv_results = result["cv_results"].round(3)
-    model_name = result["model"]
-    param_name = list(param_grids[model_name].keys())[0]
-    cv_results[param_name] = cv_results["param_" + param_name]
-    cv_results["model"] = model_name
-
-    scatter_fig = px.scatter(
-        cv_results,
-        x="mean_fit_time",
-        y="mean_test_score",
-        error_x="std_fit_time",
-        error_y="std_test_score",
-        hover_data=param_name,
-        color="model",
+def plot_results(results) :
+    import plotly.colors as colors
+    import plotly.express as px
+    from plotly.subplots import make_subplots
+
+    fig = make_subplots(
+        rows=1,
+        cols=2,
+        shared_yaxes=True,
+        subplot_titles=["Train time vs score", "Predict time vs score"],
     )
-    line_fig = px.line(
-        cv_results,
-        x="mean_fit_time",
-        y="mean_test_score",
+    model_names = [result["model"] for result in results]
+    colors_list = colors.qualitative.Plotly * (
+        len(model_names) // len(colors.qualitative.Plotly) + 1
     )
 
-    scatter_trace = scatter_fig["data"][0]
-    line_trace = line_fig["data"][0]
-    scatter_trace.update(marker=dict(color=colors_list[idx]))
-    line_trace.update(line=dict(color=colors_list[idx]))
-    fig.add_trace(scatter_trace, row=1, col=1)
-    fig.add_trace(line_trace, row=1, col=1)
-
-    scatter_fig = px.scatter(
-        cv_results,
-        x="mean_score_time",
-        y="mean_test_score",
-        error_x="std_score_time",
-        error_y="std_test_score",
-        hover_data=param_name,
-    )
-    line_fig = px.line(
-        cv_results,
-        x="mean_score_time",
-        y="mean_test_score",
+    for idx, result in enumerate(results):
+        cv_results = result["cv_results"].round(3)
+        model_name = result["model"]
+        param_name = list(param_grids[model_name].keys())[0]
+        cv_results[param_name] = cv_results["param_" + param_name]
+        cv_results["model"] = model_name
+
+        scatter_fig = px.scatter(
+            cv_results,
+            x="mean_fit_time",
+            y="mean_test_score",
+            error_x="std_fit_time",
+            error_y="std_test_score",
+            hover_data=param_name,
+            color="model",
+        )
+        line_fig = px.line(
+            cv_results,
+            x="mean_fit_time",
+            y="mean_test_score",
+        )
+
+        scatter_trace = scatter_fig["data"][0]
+        line_trace = line_fig["data"][0]
+        scatter_trace.update(marker=dict(color=colors_list[idx]))
+        line_trace.update(line=dict(color=colors_list[idx]))
+        fig.add_trace(scatter_trace, row=1, col=1)
+        fig.add_trace(line_trace, row=1, col=1)
+
+        scatter_fig = px.scatter(
+            cv_results,
+            x="mean_score_time",
+            y="mean_test_score",
+            error_x="std_score_time",
+            error_y="std_test_score",
+            hover_data=param_name,
+        )
+        line_fig = px.line(
+            cv_results,
+            x="mean_score_time",
+            y="mean_test_score",
+        )
+
+        scatter_trace = scatter_fig["data"][0]
+        line_trace = line_fig["data"][0]
+        scatter_trace.update(marker=dict(color=colors_list[idx]))
+        line_trace.update(line=dict(color=colors_list[idx]))
+        fig.add_trace(scatter_trace, row=1, col=2)
+        fig.add_trace(line_trace, row=1, col=2)
+
+    fig.update_layout(
+        xaxis=dict(title="Train time (s) - lower is better"),
+        yaxis=dict(title="Test R2 score - higher is better"),
+        xaxis2=dict(title="Predict time (s) - lower is better"),
+        legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
+        title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
     )
+    fig.show()
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(
+                    prog = 'sklearn_decisiontrees.py',
+                    description = 'Cross validates Random Forests and compares them to Hist Gradient Boosting')
+    parser.add_argument('--jobs', metavar = "N", type = int, default = -1, help = "Fits folds and parameter settings across N processes, -1 for every core")
+    parser.add_argument('--cache-dir', metavar = "dir", default = str(CACHE_DIR), help = "Where fold scores (and with --save-models, fitted models) are cached between runs")
+    parser.add_argument('--save-models', action = "store_true", help = "Also writes every fitted fold's model to the cache directory, for inspection with joblib.load")
+    parser.add_argument('--no-cache', action = "store_true", help = "Fits everything again without reading or writing the cache")
+    parser.add_argument('--no-plot', action = "store_true", help = "Skips the plotly scatterplot")
+    parser.add_argument('--serving', metavar = "file", nargs = "?", const = "-", help = "Only measures the prediction latency, memory and size of every grid setting and prints (or writes to file as CSV) the accuracy/cost Pareto report")
+    args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if args.serving :
+        X, y = load_breast_cancer(return_X_y=True, as_frame=True)
+        report = serving_benchmark(X, y)
+        if args.serving == "-" :
+            print(report.round(4).to_string())
+        else :
+            report.to_csv(args.serving, index=False)
+            print("Wrote the serving report to %s" % args.serving)
+        raise SystemExit
+
+    # Used the digits dataset as the more complex dataset where each datapoint is a 8x8 image of a digit
+    # Classes: 10 Samples total: 1797 Dimensionality: 64
+    iris = load_digits()
+    X, y = iris.data, iris.target
+    print(kfold_scores(X, y, n_jobs = args.jobs, cache_dir = cache_dir))
+
+    X,y = load_breast_cancer(return_X_y=True, as_frame=True)
+    print(f"Number of physical cores: {N_CORES}")
+    results = grid_search(X, y, args.jobs, cache_dir, args.save_models)
+    print(results)
+    print(timing_report(results).to_string())
 
-    scatter_trace = scatter_fig["data"][0]
-    line_trace = line_fig["data"][0]
-    scatter_trace.update(marker=dict(color=colors_list[idx]))
-    line_trace.update(line=dict(color=colors_list[idx]))
-    fig.add_trace(scatter_trace, row=1, col=2)
-    fig.add_trace(line_trace, row=1, col=2)
-
-fig.update_layout(
-    xaxis=dict(title="Train time (s) - lower is better"),
-    yaxis=dict(title="Test R2 score - higher is better"),
-    xaxis2=dict(title="Predict time (s) - lower is better"),
-    legend=dict(x=0.72, y=0.05, traceorder="normal", borderwidth=1),
-    title=dict(x=0.5, text="Speed-score trade-off of tree-based ensembles"),
-)
-fig.show()
\ No newline at end of file
+    if not args.no_plot :
+        plot_results(results)
@@ -1,6 +1,16 @@
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.request
 from collections import defaultdict
 from unittest import TestCase
-from HMM import HMM
+
+import numpy
+from HMM import HMM, Profiler, TagCounter, beam_report, read_tagged, train_tagged
 
 class MyTestCase(TestCase):
     def test_load(self):
@@ -32,8 +42,342 @@ class MyTestCase(TestCase):
         likely_states = h.viterbi(seq)
         self.assertEqual(likely_states, ["PRON", "VERB", "DET", "NOUN", "."])
 
-        # Taken from example given during class (on slides)
+        # Taken from example given during class (on slides), the best path ends in hungry:
+        # P(... happy, hungry) = 0.0002592 > P(... happy, happy) = 0.000162
         seq = ["purr", "silent", "silent", "meow", "meow"]
         h.load("cat")
         likely_states = h.viterbi(seq)
-        self.assertEqual(likely_states, ["happy", "hungry", "grumpy", "happy", "happy"])
+        self.assertEqual(likely_states, ["happy", "hungry", "grumpy", "happy", "hungry"])
+
+    def test_engines_match(self) :
+        # The compiled NumPy engine has to give the same answers as the dictionary loops
+        seqs = {"cat" : [["purr", "silent", "silent", "meow", "meow"], ["meow", "silent", "meow", "silent"]],
+                "lander" : [["1,1", "2,1", "2,3", "4,4", "4,5", "5,5", "5,5", "5,4", "5,5"], ["2,1", "2,1", "3,2", "4,3"]],
+                "partofspeech" : [["did", "you", "train", "her", "?"], ["they", "book", "the", "ticket", "."]]}
+        for basename, sequences in seqs.items() :
+            dense = HMM()
+            dense.load(basename)
+            loops = HMM(engine="dict")
+            loops.load(basename)
+            for seq in sequences :
+                self.assertEqual(dense.forward(seq), loops.forward(seq))
+                self.assertEqual(dense.viterbi(seq), loops.viterbi(seq))
+
+    def test_logspace(self) :
+        # Short sequences give the same answers as plain probabilities
+        seq = ["purr", "silent", "silent", "meow", "meow"]
+        h = HMM(logspace=True)
+        h.load("cat")
+        self.assertEqual(h.viterbi(seq), ["happy", "hungry", "grumpy", "happy", "hungry"])
+        self.assertEqual(h.forward(seq), "hungry")
+        decoded = h.decode(seq)
+        self.assertAlmostEqual(decoded.logprob, math.log(0.0002592))
+
+        # A few thousand partofspeech tokens underflow plain probabilities to 0 but not log space
+        sentence = ["i", "shot", "the", "elephant", "."]
+        h.load("partofspeech")
+        decoded = h.decode(sentence * 600)
+        self.assertEqual(decoded.stateseq, ["PRON", "VERB", "DET", "NOUN", "."] * 600)
+        self.assertTrue(decoded.logprob < decoded.loglikelihood < 0)
+        self.assertTrue(math.isfinite(h.log_likelihood(sentence * 600)))
+
+    def test_compiled_cache(self) :
+        with tempfile.TemporaryDirectory() as tmp :
+            basename = os.path.join(tmp, "cat")
+            shutil.copy("cat.trans", basename + ".trans")
+            shutil.copy("cat.emit", basename + ".emit")
+            h = HMM()
+            h.load(basename)
+            self.assertTrue(os.path.isfile(basename + ".npz"))
+
+            # The second load maps the cached arrays and only parses the text if asked to
+            cached = HMM()
+            cached.load(basename)
+            self.assertIsNone(cached._transitions)
+            self.assertEqual(cached.states, h.states)
+            self.assertEqual(cached.viterbi(["purr", "silent", "meow"]), h.viterbi(["purr", "silent", "meow"]))
+            self.assertTrue((cached.trans_probs == h.trans_probs).all())
+            self.assertEqual(cached.emissions, h.emissions)
+
+            # Editing a source file makes the cache stale
+            with open(basename + ".emit", "a") as f :
+                f.write("happy hiss 0.0\n")
+            future = os.path.getmtime(basename + ".npz") + 10
+            os.utime(basename + ".emit", (future, future))
+            reloaded = HMM()
+            reloaded.load(basename)
+            self.assertIn("hiss", reloaded.symbol_index)
+
+            # A cache cut short is rebuilt from the text, and no temporary files are left behind
+            with open(basename + ".npz", "r+b") as f :
+                f.truncate(os.path.getsize(basename + ".npz") // 2)
+            os.utime(basename + ".npz", (future + 10, future + 10))
+            truncated = HMM()
+            truncated.load(basename)
+            self.assertIn("hiss", truncated.symbol_index)
+            self.assertEqual(sorted(os.listdir(tmp)), ["cat.emit", "cat.npz", "cat.trans"])
+
+    def test_batch(self) :
+        h = HMM()
+        h.load("partofspeech")
+        with open("ambiguous_sents.obs") as f :
+            sentences = [line.split() for line in f if line.strip()]
+        expected = [h.viterbi(sentence) for sentence in sentences]
+        self.assertEqual(h.viterbi_batch(sentences), expected)
+        # Results come back in input order from the process pool
+        self.assertEqual(h.viterbi_batch(sentences, jobs=2, chunksize=1), expected)
+        # A generator spanning several of the blocks the pool is fed in
+        self.assertEqual(h.viterbi_batch((sentence for sentence in sentences * 5), jobs=2, chunksize=1), expected * 5)
+        self.assertEqual(h.forward_batch(sentences, jobs=2), [h.forward(sentence) for sentence in sentences])
+
+    def test_filter(self) :
+        h = HMM()
+        h.load("lander")
+        seq = ["1,1", "2,2", "3,3", "3,4", "4,4"]
+        tracker = h.filter()
+        states = list(tracker.run(iter(seq)))
+        self.assertEqual(states, [h.forward(seq[:i + 1]) for i in range(len(seq))])
+        self.assertAlmostEqual(tracker.loglikelihood, h.log_likelihood(seq))
+        self.assertAlmostEqual(tracker.belief.sum(), 1.0)
+        self.assertTrue(0.5 < tracker.safe_land_probability() <= 1.0)
+
+    def test_sparse(self) :
+        seqs = {"cat" : ["purr", "silent", "silent", "meow", "meow"],
+                "lander" : ["1,1", "2,1", "2,3", "4,4", "4,5", "5,5", "5,5", "5,4", "5,5"],
+                "partofspeech" : ["they", "book", "the", "ticket", "."]}
+        for basename, seq in seqs.items() :
+            dense = HMM(logspace=True)
+            dense.load(basename)
+            sparse = HMM(engine="sparse")
+            sparse.load(basename)
+            self.assertEqual(sparse.viterbi(seq), dense.viterbi(seq))
+            self.assertEqual(sparse.forward(seq), dense.forward(seq))
+            self.assertAlmostEqual(sparse.decode(seq).logprob, dense.decode(seq).logprob)
+            self.assertAlmostEqual(sparse.log_likelihood(seq), dense.log_likelihood(seq))
+
+        # Each lander cell only reaches 3 others, so the predecessor lists hold 3 entries per state at most
+        lander = HMM(engine="sparse")
+        lander.load("lander")
+        self.assertLessEqual(len(lander.pred_states), 3 * len(lander.states))
+        self.assertEqual(lander.filter().update("1,1"), "1,1")
+
+    def test_beam(self) :
+        seq = ["the", "pilot", "flies", "the", "plane", "."]
+        exact = HMM(logspace=True)
+        exact.load("partofspeech")
+        for engine in ("dense", "sparse") :
+            # A beam as wide as the state space is exact
+            h = HMM(engine=engine, beam=len(exact.states))
+            h.load("partofspeech")
+            self.assertEqual(h.viterbi(seq), exact.viterbi(seq))
+            h = HMM(engine=engine, beam=2, beam_threshold=50.0)
+            h.load("partofspeech")
+            self.assertEqual(h.viterbi(seq), ["DET", "NOUN", "VERB", "DET", "NOUN", "."])
+
+        report = beam_report("partofspeech", "ambiguous_sents.tagged.obs", widths=(1, 4), repeat=1)
+        self.assertEqual([row["beam"] for row in report], [None, 1, 4])
+        self.assertEqual(report[0]["agreement"], 1.0)
+        self.assertEqual(report[2]["accuracy"], report[0]["accuracy"])
+
+        with self.assertRaises(ValueError) :
+            HMM(beam=0)
+        with self.assertRaises(ValueError) :
+            HMM(beam_threshold=-1.0)
+
+    def test_generate(self) :
+        h = HMM()
+        h.load("lander")
+        sequence = h.generate(500, seed=7, states=True)
+        self.assertEqual(len(sequence), 500)
+        self.assertEqual(sequence.stateseq[0], "1,1")
+        # Every step follows a transition and every observation an emission the model allows
+        for prev, state in zip(sequence.stateseq, sequence.stateseq[1:]) :
+            self.assertGreater(float(h.transitions[prev][state]), 0)
+        for state, output in zip(sequence.stateseq, sequence.outputseq) :
+            self.assertGreater(float(h.emissions[state][output]), 0)
+        self.assertEqual(h.generate(50, seed=3), h.generate(50, seed=3))
+
+        with tempfile.TemporaryDirectory() as tmp :
+            path = os.path.join(tmp, "lander.obs")
+            h.write_generated(path, 25, seed=7, states=True, per_line=10)
+            pairs = list(read_tagged(path))
+        self.assertEqual([len(words) for tags, words in pairs], [10, 10, 5])
+        self.assertEqual(sum((tags for tags, words in pairs), []), h.generate(25, seed=7, states=True).stateseq)
+
+    def test_posteriors(self) :
+        seq = ["purr", "silent", "silent", "meow", "meow"]
+        h = HMM()
+        h.load("cat")
+        gamma = h.posteriors(seq)
+        self.assertTrue(numpy.allclose(gamma.sum(axis=1), 1.0))
+        # P(state at t=3 | seq) worked out by summing over all 3^5 paths
+        self.assertTrue(numpy.allclose(gamma[2], [0.3203057, 0.4636068, 0.2160875]))
+
+    def test_baum_welch(self) :
+        h = HMM()
+        h.load("cat")
+        corpus = [h.generate(30, seed=seed) for seed in range(40)]
+        history = h.baum_welch(corpus, iterations=5)
+        # EM never lowers the likelihood
+        self.assertTrue(all(after >= before - 1e-9 for before, after in zip(history, history[1:])))
+        self.assertAlmostEqual(sum(float(p) for p in h.transitions["happy"].values()), 1.0)
+
+        parallel = HMM()
+        parallel.load("cat")
+        self.assertTrue(numpy.allclose(parallel.baum_welch(lambda: iter(corpus), iterations=5, batch_size=7, jobs=2), history))
+        with tempfile.TemporaryDirectory() as tmp :
+            basename = os.path.join(tmp, "cat_trained")
+            h.save(basename)
+            trained = HMM()
+            trained.load(basename)
+        self.assertTrue(numpy.allclose(trained.trans_probs, h.trans_probs))
+        self.assertTrue(numpy.allclose(trained.emit_probs, h.emit_probs))
+        self.assertEqual(trained.viterbi(corpus[0]), h.viterbi(corpus[0]))
+
+    def test_train_tagged(self) :
+        h = train_tagged("ambiguous_sents.tagged.obs", smoothing=0.0)
+        # 4 of the 11 sentences start with DET, and "the" is 9 of the 14 DET tokens
+        self.assertAlmostEqual(float(h.transitions["#"]["DET"]), 4 / 11)
+        self.assertAlmostEqual(float(h.emissions["DET"]["the"]), 9 / 14)
+        for tags, words in read_tagged("ambiguous_sents.tagged.obs") :
+            self.assertEqual(h.viterbi(words), tags)
+
+        # Counting the corpus in two halves and merging gives the same counts
+        pairs = list(read_tagged("ambiguous_sents.tagged.obs"))
+        whole = TagCounter().update(pairs)
+        first, second = TagCounter(), TagCounter()
+        first.flush_size = 3
+        first.update(pairs[:5])
+        second.update(pairs[:4:-1])
+        first.merge(second)
+        merged = first.to_hmm()
+        smoothed = whole.to_hmm()
+        self.assertEqual(sorted(merged.states), sorted(smoothed.states))
+        for tag in smoothed.states :
+            self.assertEqual(merged.emissions[tag], smoothed.emissions[tag])
+            self.assertAlmostEqual(float(merged.transitions["#"][tag]), float(smoothed.transitions["#"][tag]))
+
+        # The CLI writes the trained model through --save and won't overwrite an existing one
+        with tempfile.TemporaryDirectory() as tmp :
+            basename = os.path.join(tmp, "tagged")
+            command = [sys.executable, "HMM.py", "partofspeech", "--train-tagged", "ambiguous_sents.tagged.obs", "--save", basename]
+            here = os.path.dirname(os.path.abspath(__file__))
+            subprocess.run(command, capture_output=True, check=True, cwd=here)
+            trained = HMM()
+            trained.load(basename)
+            self.assertEqual(trained.viterbi(pairs[0][1]), pairs[0][0])
+            refused = subprocess.run(command, capture_output=True, text=True, cwd=here)
+            self.assertEqual(refused.returncode, 2)
+            self.assertIn("--force", refused.stderr)
+            subprocess.run(command + ["--force"], capture_output=True, check=True, cwd=here)
+
+    def test_unknown_words(self) :
+        seq = ["she", "quizzically", "flurbed", "1984", "zorbs", "."]
+        h = HMM(logspace=True)
+        h.load("partofspeech")
+        # By default no tag emits an unknown word, so the sentence is impossible
+        self.assertEqual(h.log_likelihood(seq), -math.inf)
+        for engine in ("dense", "sparse") :
+            h = HMM(engine=engine, oov="suffix")
+            h.load("partofspeech")
+            self.assertEqual(h.viterbi(seq), ["PRON", "ADV", "VERB", "NUM", "NOUN", "."])
+            self.assertTrue(math.isfinite(h.log_likelihood(seq)))
+        self.assertEqual(HMM.word_classes("1984"), ["<number>", "-984", "-84", "-4"])
+        self.assertTrue(numpy.allclose(h.posteriors(seq).sum(axis=1), 1.0))
+
+    def test_nbest(self) :
+        h = HMM()
+        h.load("partofspeech")
+        seq = "he took my shot at the elephant .".split()
+        paths = h.nbest(seq, 4)
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(paths[0].stateseq, h.viterbi(seq))
+        scores = [path.logprob for path in paths]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(len(set(tuple(path.stateseq) for path in paths)), 4)
+        # Each score is the joint log probability of its own path
+        second = paths[1].stateseq
+        expected = math.log(float(h.transitions["#"][second[0]]) * float(h.emissions[second[0]][seq[0]]))
+        for t in range(1, len(seq)) :
+            expected += math.log(float(h.transitions[second[t - 1]][second[t]]) * float(h.emissions[second[t]][seq[t]]))
+        self.assertAlmostEqual(paths[1].logprob, expected)
+        confidences = h.confidences(seq)
+        self.assertEqual(len(confidences), len(seq))
+        self.assertTrue(all(0 < p <= 1 + 1e-9 for p in confidences))
+        self.assertLess(confidences[3], confidences[0])
+
+    def test_server(self) :
+        from hmm_server import HMMServer
+        h = HMM(logspace=True)
+        h.load("partofspeech")
+        server = HMMServer(h)
+        port = server.run_in_thread()
+        def post(path, body) :
+            request = urllib.request.Request("http://127.0.0.1:%d/%s" % (port, path), json.dumps(body).encode())
+            with urllib.request.urlopen(request) as response :
+                return json.load(response)
+        try :
+            for _ in range(2) :
+                result = post("viterbi", {"sentence": "i shot the elephant .", "nbest": 2})
+            self.assertEqual(result["states"], h.viterbi("i shot the elephant .".split()))
+            self.assertEqual(len(result["nbest"]), 2)
+            self.assertEqual(post("forward", {"tokens": ["the", "dog"]})["state"], h.forward(["the", "dog"]))
+            self.assertEqual(len(post("generate", {"n": 7, "seed": 3})["observations"]), 7)
+            # Bad requests get a 400 instead of no answer
+            for path, body in (("generate", {"seed": [1]}), ("generate", {"seed": -1}), ("generate", {"n": 10 ** 9}),
+                               ("viterbi", {"sentence": "the dog", "nbest": 10 ** 6})) :
+                with self.assertRaises(urllib.error.HTTPError) as error :
+                    post(path, body)
+                self.assertEqual(error.exception.code, 400)
+            with urllib.request.urlopen("http://127.0.0.1:%d/stats" % port) as response :
+                stats = json.load(response)
+            self.assertEqual(stats["cache_hits"], 1)
+        finally :
+            server.stop()
+
+    def test_minimal_imports(self) :
+        # Loading and decoding needs only the standard library and NumPy
+        script = ("import sys, HMM; h = HMM.HMM(); h.load('partofspeech'); h.viterbi('the dog .'.split()); "
+                  "print(' '.join(sorted({name.split('.')[0] for name in sys.modules})))")
+        modules = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        for heavy in ("torch", "pgmpy", "sklearn", "pandas", "multiprocessing") :
+            self.assertNotIn(heavy, modules)
+        self.assertIn("numpy", modules)
+
+    def test_profiler(self) :
+        seq = "he took my shot at the elephant .".split()
+        with Profiler() as profile :
+            h = HMM(beam=1)
+            h.load("partofspeech")
+            h.viterbi(seq)
+            h.decode(seq)
+        h.viterbi(seq)
+        summary = profile.summary()
+        self.assertEqual(summary["viterbi"]["calls"], 1)
+        self.assertEqual(summary["decode"]["tokens"], len(seq))
+        self.assertEqual(summary["decode"]["lattice_cells"], len(seq) * len(h.states))
+        self.assertIn("load", summary)
+        self.assertGreater(profile.counters["states_pruned"], 0)
+        self.assertIn("tokens/s", profile.report())
+        path = os.path.join(tempfile.mkdtemp(), "trace.json")
+        profile.save(path, "chrome")
+        with open(path) as f :
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(len(events), len(profile.events))
+        self.assertTrue(all(event["ph"] == "X" and event["dur"] >= 0 for event in events))
+
+    def test_checkpoint(self) :
+        for options in (dict(), dict(engine="sparse"), dict(beam=2)) :
+            full = HMM(logspace=True, **options)
+            full.load("lander")
+            checkpointed = HMM(logspace=True, checkpoint=True, **options)
+            checkpointed.load("lander")
+            for n in (1, 2, 50, 401) :
+                seq = full.generate(n, seed=n)
+                self.assertEqual(checkpointed.viterbi(seq), full.viterbi(seq))
+                self.assertEqual(checkpointed.decode(seq).logprob, full.decode(seq).logprob)
+                # Any segment length gives the same path
+                path, logprob = checkpointed._viterbi_checkpoint(seq, 3)
+                self.assertEqual([checkpointed.states[idx] for idx in path], full.viterbi(seq))
+        self.assertEqual(path.dtype, numpy.uint16)
@@ -0,0 +1,41 @@
+import itertools
+from unittest import TestCase
+
+import numpy
+import pandas
+from alarm import alarm_compiled, alarm_infer
+from carnet import car_compiled, car_infer
+
+
+class MyTestCase(TestCase):
+    def test_matches_variable_elimination(self):
+        queries = [(alarm_compiled, alarm_infer, ["JohnCalls"], {"Earthquake": "yes"}),
+                   (alarm_compiled, alarm_infer, ["JohnCalls", "Earthquake"], {"Burglary": "yes", "MaryCalls": "yes"}),
+                   (alarm_compiled, alarm_infer, ["Alarm"], {})]
+        for moves, gas in itertools.product(["yes", "no"], ["Full", "Empty"]):
+            queries.append((car_compiled, car_infer, ["Ignition", "Battery"], {"Moves": moves, "Gas": gas}))
+        for compiled, infer, variables, evidence in queries:
+            expected = infer.query(variables, evidence=evidence, show_progress=False)
+            self.assertEqual(compiled.query(variables, evidence), expected)
+        # The KeyPresent answer printed in carnet.py, the others there predate the KeyPresent node
+        self.assertAlmostEqual(car_compiled.probabilities(["KeyPresent"], {"Moves": "no"})[0], 0.6604, places=4)
+
+    def test_bad_queries(self):
+        with self.assertRaises(ValueError):
+            car_compiled.query(["Moves"], {"Moves": "no"})
+        with self.assertRaises(ValueError):
+            car_compiled.query(["Moves"], {"Gas": "Half"})
+        with self.assertRaises(ValueError):
+            car_compiled.query(["Wheels"])
+
+    def test_batch(self):
+        rows = [{"Moves": "no", "Gas": "Empty"}, {"Moves": "yes"}, {}, {"Radio": "turns on", "Gas": "Full"}]
+        batch = car_compiled.probabilities_batch(["Ignition", "Battery"], rows)
+        self.assertEqual(batch.shape, (4, 2, 2))
+        for row, probabilities in zip(rows, batch):
+            self.assertTrue(numpy.allclose(probabilities, car_compiled.probabilities(["Ignition", "Battery"], row)))
+        # A DataFrame with missing values gives the same answers
+        frame = pandas.DataFrame(rows)
+        self.assertTrue(numpy.allclose(car_compiled.probabilities_batch(["Ignition", "Battery"], frame), batch))
+        with self.assertRaises(ValueError):
+            car_compiled.probabilities_batch(["Moves"], [{"Gas": "Half"}])
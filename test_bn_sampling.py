@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import numpy
+from bn_sampling import SamplingInference, effective_sample_size, split_rhat
+from carnet import car_compiled, car_model
+
+
+class MyTestCase(TestCase):
+    def test_matches_exact(self):
+        sampler = SamplingInference(car_model)
+        for variables, evidence in [(["Battery"], {"Moves": "no"}), (["KeyPresent"], {"Moves": "no"}),
+                                    (["Ignition", "Gas"], {"Moves": "no", "Radio": "turns on"})]:
+            exact = car_compiled.probabilities(variables, evidence)
+            for estimate in (sampler.likelihood_weighting(variables, evidence, tolerance=0.005, seed=0),
+                             sampler.gibbs(variables, evidence, tolerance=0.01, seed=0)):
+                self.assertTrue(estimate.converged)
+                self.assertEqual(estimate.probabilities.shape, exact.shape)
+                self.assertTrue(numpy.all(numpy.abs(estimate.probabilities - exact) <= 4 * estimate.stderr + 1e-3))
+        factor = sampler.query(["Battery"], {"Moves": "no"}, method="gibbs", seed=0)
+        self.assertEqual(factor.state_names["Battery"], ["Works", "Doesn't work"])
+
+    def test_budget_and_diagnostics(self):
+        sampler = SamplingInference(car_model)
+        # Too tight a tolerance to reach, so the time limit stops it
+        estimate = sampler.gibbs(["Moves"], tolerance=1e-6, time_limit=0.5, seed=0)
+        self.assertFalse(estimate.converged)
+        self.assertLess(estimate.seconds, 3)
+        rng = numpy.random.default_rng(0)
+        mixed = rng.normal(size=(4, 1000))
+        self.assertAlmostEqual(split_rhat(mixed), 1.0, delta=0.01)
+        self.assertGreater(split_rhat(mixed + numpy.arange(4)[:, None]), 1.5)
+        self.assertGreater(effective_sample_size(mixed), 2000)
+        # A chain that barely moves carries far less information than its length
+        sticky = numpy.repeat(rng.normal(size=(4, 50)), 20, axis=1)
+        self.assertLess(effective_sample_size(sticky), 400)
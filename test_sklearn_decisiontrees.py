@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import warnings
+from pathlib import Path
+from unittest import TestCase
+
+import numpy
+import pandas
+from sklearn.datasets import load_iris
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import GridSearchCV, KFold
+from sklearn_decisiontrees import cross_validate_cached, pareto_front, serving_costs
+
+
+class MyTestCase(TestCase):
+    def test_cross_validate_cached(self):
+        X, y = load_iris(return_X_y=True)
+        model = RandomForestClassifier(random_state=0)
+        grid = {"n_estimators": [3, 6], "max_depth": [2, None]}
+        cv = KFold(n_splits=3, shuffle=True, random_state=0)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            first = cross_validate_cached(model, grid, X, y, cv, n_jobs=2, cache_dir=cache_dir)
+            self.assertEqual(list(first["cached_folds"]), [0, 0, 0, 0])
+            # Only the scores are cached unless the fitted models are asked for
+            self.assertFalse(list(Path(cache_dir).glob("*.model")))
+            expected = GridSearchCV(model, grid, cv=cv).fit(X, y).cv_results_
+            self.assertTrue(numpy.allclose(first["mean_test_score"], expected["mean_test_score"]))
+            self.assertEqual(list(first["rank_test_score"]), list(expected["rank_test_score"]))
+            # A rerun reads every fold back, and one new setting only fits its own folds
+            grid["n_estimators"].append(9)
+            second = cross_validate_cached(model, grid, X, y, cv, n_jobs=2, cache_dir=cache_dir)
+            self.assertEqual(sorted(second["cached_folds"]), [0, 0, 3, 3, 3, 3])
+            self.assertTrue(numpy.allclose(second.set_index(second["params"].astype(str)).loc[first["params"].astype(str), "mean_test_score"],
+                                           first["mean_test_score"]))
+            # Unseeded forests differ from run to run, so they're always fit
+            cross_validate_cached(model, {"n_estimators": [4]}, X, y, cv, n_jobs=2, cache_dir=cache_dir, save_models=True)
+            self.assertEqual(len(list(Path(cache_dir).glob("*.model"))), 3)
+            for _ in range(2):
+                unseeded = cross_validate_cached(RandomForestClassifier(n_estimators=3), {}, X, y, cv, n_jobs=2, cache_dir=cache_dir)
+            self.assertEqual(list(unseeded["cached_folds"]), [0])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_serving_costs(self):
+        X, y = load_iris(return_X_y=True)
+        model = RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y)
+        costs = serving_costs(model, X, y, batch_sizes=(1, 10), single_rows=5, repeat=2)
+        self.assertEqual(costs["accuracy"], model.score(X, y))
+        for cost in ("single_median_ms", "single_p95_ms", "batch1_ms", "batch10_ms", "rows_per_s", "serialized_kb", "memory_kb"):
+            self.assertGreater(costs[cost], 0)
+        # A model fit on a DataFrame is served DataFrame rows, without sklearn's feature name warnings
+        X_frame, y_frame = load_iris(return_X_y=True, as_frame=True)
+        model = RandomForestClassifier(n_estimators=5, random_state=0).fit(X_frame, y_frame)
+        with warnings.catch_warnings() :
+            warnings.simplefilter("error")
+            serving_costs(model, X_frame, y_frame, batch_sizes=(1, 10), single_rows=5, repeat=2)
+            serving_costs(model, X_frame.to_numpy(), y_frame, batch_sizes=(1, 10), single_rows=5, repeat=2)
+        frame = pandas.DataFrame({"accuracy": [0.9, 0.95, 0.9, 0.99], "cost": [1.0, 2.0, 3.0, 2.0]})
+        # The third is beaten by the first, the second by the fourth
+        self.assertEqual(list(pareto_front(frame, "cost")), [True, False, False, True])